@@ -0,0 +1,2 @@
+# inspect_test.py is a python 2 script, not a test
+collect_ignore = ['inspect_test.py']
@@ -0,0 +1,334 @@
+"""
+Overhead benchmarks of ezprint and ezconfig, only standard library is needed.
+
+    python ezbench.py                      # run and print the results
+    python ezbench.py --out results.json   # also write machine-readable results
+    python ezbench.py --save-baseline      # store the results as the baseline
+    python ezbench.py --compare            # compare with the baseline, exit code 1 on regression
+
+All results are times (lower is better), the comparison flags the benchmarks that got slower than the baseline by more
+than the tolerance.
+"""
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import timeit
+
+from ezconfig import ConfigFile
+from ezprint import FastPrint, JsonPrinter
+
+
+BENCHMARKS = []
+
+
+def benchmark(unit):
+    """
+    Registers benchmark function, it gets the number of operations and returns time of one operation in unit.
+    """
+    def register(func):
+        BENCHMARKS.append((func.__name__, unit, func))
+        return func
+    return register
+
+
+def best_time(func, number, repeat):
+    """
+    Returns the best time of a single call of func in seconds, out of repeat runs of number calls.
+    """
+    timer = timeit.Timer(func)
+    return min(timer.repeat(repeat=repeat, number=number)) / number
+
+
+class Context(object):
+    # temporary directory with a separate FastPrint config, so that the benchmarks don't touch the CWD
+    def __init__(self, quick=False):
+        self.quick = quick
+        self.tmpdir = tempfile.mkdtemp(prefix='ezbench')
+        self.repeat = 3 if quick else 5
+
+    def fastprint(self, **config):
+        with contextlib.redirect_stdout(io.StringIO()): # message about creating the config file
+            ff = FastPrint(os.path.join(self.tmpdir, 'fastprint_config.txt'))
+            ff.configfile # the config is loaded on the first use
+        config.setdefault('max_depth', 10000)
+        ff.config(**config)
+        return ff
+
+    def scale(self, n):
+        return max(n // 10, 1) if self.quick else n
+
+    def close(self):
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+def traced_calls(ctx, ff, call, number):
+    # time per traced call, the trace is cleared between the repeats so that it doesn't grow
+    def run():
+        ff.clear()
+        for _ in range(number):
+            call()
+    return min(timeit.Timer(run).repeat(repeat=ctx.repeat, number=1)) / number
+
+
+def add(a, b=2):
+    return a + b
+
+
+@benchmark('ns/call')
+def call_plain(ctx):
+    return best_time(lambda: add(1, b=3), ctx.scale(100000), ctx.repeat) * 1e9
+
+
+@benchmark('ns/call')
+def ff_simple(ctx):
+    ff = ctx.fastprint(simple=True)
+    traced = ff(add)
+    return traced_calls(ctx, ff, lambda: traced(1, b=3), ctx.scale(20000)) * 1e9
+
+
+@benchmark('ns/call')
+def ff_full(ctx):
+    ff = ctx.fastprint(simple=False)
+    traced = ff(add)
+    return traced_calls(ctx, ff, lambda: traced(1, b=3), ctx.scale(20000)) * 1e9
+
+
+@benchmark('ns/call')
+def ff_full_events(ctx):
+    ff = ctx.fastprint(simple=False, backend='events')
+    traced = ff(add)
+    return traced_calls(ctx, ff, lambda: traced(1, b=3), ctx.scale(20000)) * 1e9
+
+
+@benchmark('ns/call')
+def ff_recursion(ctx):
+    ff = ctx.fastprint(simple=False)
+    depth = 100
+
+    @ff
+    def recurse(n):
+        return recurse(n - 1) if n > 0 else 0
+
+    return traced_calls(ctx, ff, lambda: recurse(depth), ctx.scale(200)) / (depth + 1) * 1e9
+
+
+@benchmark('ns/call')
+def ff_large_args_str(ctx):
+    ff = ctx.fastprint(simple=False, capture='str')
+    data = list(range(10000))
+
+    @ff
+    def consume(values):
+        ff(values=values)
+        return values
+
+    return traced_calls(ctx, ff, lambda: consume(data), ctx.scale(200)) * 1e9
+
+
+@benchmark('ns/call')
+def ff_large_args_ref(ctx):
+    ff = ctx.fastprint(simple=False, capture='ref')
+    data = list(range(10000))
+
+    @ff
+    def consume(values):
+        ff(values=values)
+        return values
+
+    return traced_calls(ctx, ff, lambda: consume(data), ctx.scale(200)) * 1e9
+
+
+class Counter(object):
+    def __init__(self):
+        self.n = 0
+
+    def add(self, k):
+        self.n += k
+        return self.n
+
+
+@benchmark('ns/call')
+def method_plain(ctx):
+    counter = Counter()
+    return best_time(lambda: counter.add(1), ctx.scale(100000), ctx.repeat) * 1e9
+
+
+@benchmark('ns/call')
+def ff_class_method(ctx):
+    ff = ctx.fastprint(simple=False)
+    counter = ff(Counter)()
+    return traced_calls(ctx, ff, lambda: counter.add(1), ctx.scale(20000)) * 1e9
+
+
+def build_trace(ctx, nrecords):
+    ff = ctx.fastprint(simple=False)
+
+    @ff
+    def outer(i):
+        ff(i=i)
+        return inner(i)
+
+    @ff
+    def inner(i):
+        return i
+
+    for i in range(nrecords // 8): # 8 records per outer call
+        outer(i)
+    return ff
+
+
+def render(ctx, nrecords, collapse=False):
+    ff = build_trace(ctx, ctx.scale(nrecords))
+    printer = JsonPrinter() if collapse else JsonPrinter(ncols=None, nlistcollapse=None, ndictcollapse=None)
+    json_ = ff.json
+    return best_time(lambda: printer.write(json_, io.StringIO()), 1, ctx.repeat) * 1e3
+
+
+@benchmark('ms')
+def render_1e3(ctx):
+    return render(ctx, 1000)
+
+
+@benchmark('ms')
+def render_1e4(ctx):
+    return render(ctx, 10000)
+
+
+@benchmark('ms')
+def render_1e5(ctx):
+    return render(ctx, 100000)
+
+
+def config_file(ctx, nfields):
+    path = os.path.join(ctx.tmpdir, 'config_{}.txt'.format(nfields))
+    if not os.path.exists(path):
+        config = ConfigFile()
+        for i in range(nfields):
+            if i % 4 == 0:
+                config.add_int('int_{}'.format(i), i, comment='int field')
+            elif i % 4 == 1:
+                config.add_float('float_{}'.format(i), i / 3.0, comment='float field')
+            elif i % 4 == 2:
+                config.add_bool('bool_{}'.format(i), i % 3 == 0)
+            else:
+                config.add_string('string_{}'.format(i), 'value {}'.format(i), comment='string field')
+        config.save(path)
+    return path
+
+
+@benchmark('ms')
+def render_collapsed_1e5(ctx):
+    return render(ctx, 100000, collapse=True)
+
+
+@benchmark('ms')
+def config_load_1e5(ctx):
+    path = config_file(ctx, ctx.scale(100000))
+    return best_time(lambda: ConfigFile(path), 1, ctx.repeat) * 1e3
+
+
+@benchmark('ms')
+def config_load_cached_1e5(ctx):
+    path = config_file(ctx, ctx.scale(100000))
+    ConfigFile(path, cache=True) # writes the sidecar
+    return best_time(lambda: ConfigFile(path, cache=True), 1, ctx.repeat) * 1e3
+
+
+@benchmark('ms')
+def config_save_1e5(ctx):
+    config = ConfigFile(config_file(ctx, ctx.scale(100000)))
+    path = os.path.join(ctx.tmpdir, 'config_saved.txt')
+    return best_time(lambda: config.save(path), 1, ctx.repeat) * 1e3
+
+
+def run(names=None, quick=False, log=None):
+    """
+    Runs the benchmarks (all or the ones with given names) and returns the machine-readable results.
+    """
+    ctx = Context(quick)
+    results = {}
+    try:
+        for name, unit, func in BENCHMARKS:
+            if names and name not in names:
+                continue
+            gc.collect()
+            value = func(ctx)
+            results[name] = {'value': value, 'unit': unit}
+            if log is not None:
+                log.write('{:<22}{:>14.1f} {}\n'.format(name, value, unit))
+    finally:
+        ctx.close()
+
+    overheads = [('ff_simple', 'call_plain'), ('ff_full', 'call_plain'), ('ff_class_method', 'method_plain')]
+    for traced, plain in overheads:
+        if traced in results and plain in results:
+            results[traced]['overhead'] = results[traced]['value'] / results[plain]['value']
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'quick': quick, 'results': results}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compares results with baseline, returns list of (name, baseline value, value, ratio, is regression) for the
+    benchmarks present in both.
+    """
+    rows = []
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]['value']
+        ratio = result['value'] / base if base > 0 else float('inf')
+        rows.append((name, base, result['value'], ratio, ratio > 1 + tolerance))
+    return rows
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Overhead benchmarks of ezprint and ezconfig')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, all by default')
+    parser.add_argument('--quick', action='store_true', help='10x smaller sizes, for smoke testing')
+    parser.add_argument('--out', help='write the results as json into this file')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline')
+    parser.add_argument('--compare', action='store_true', help='compare with the baseline, exit code 1 on regression')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown against the baseline (default: %(default)s)')
+    parser.add_argument('--list', action='store_true', help='list the benchmarks')
+    args = parser.parse_args(argv)
+
+    if args.list:
+        for name, unit, _ in BENCHMARKS:
+            print('{:<22}{}'.format(name, unit))
+        return 0
+
+    results = run(args.names, args.quick, log=sys.stdout)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline.get('quick') != results['quick']:
+            print('WARNING: the baseline was measured with quick={}'.format(baseline.get('quick')))
+        rows = compare(results, baseline, args.tolerance)
+        print('-' * 60)
+        print('{:<22}{:>12}{:>12}{:>8}'.format('benchmark', 'baseline', 'current', 'ratio'))
+        for name, base, value, ratio, regression in rows:
+            print('{:<22}{:>12.1f}{:>12.1f}{:>8.2f}{}'.format(name, base, value, ratio, '  REGRESSION' if regression else ''))
+        if any(row[4] for row in rows):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,16 +1,27 @@
 import enum
+import hashlib
+import keyword
+import marshal
+import os
+import re
+import struct
+import weakref
 from enum import Enum
-import numpy as np
+
+CACHE_VERSION = 2
+CACHE_MAGIC = b'EZCONFIG-CACHE\n'
 
 class ConfigFile(object):
-    def __init__(self, filepath=None):
+    def __init__(self, filepath=None, cache=False):
         self.fields = {}
         self.paths = []
+        self.cache = cache # default of load(cache=...)
+        self._layered = None # LayeredConfigs that have this config as a layer, updated by changed
 
         if filepath is not None:
             self.load(filepath)
 
-    def load(self, filepath, overwrite=False, reload=False, virtual=False): # set reload when you want to reload all fields
+    def load(self, filepath, overwrite=False, reload=False, virtual=False, cache=None): # set reload when you want to reload all fields
         """
         Load config file from filepath.
         :param filepath: path to config
@@ -22,21 +33,122 @@ class ConfigFile(object):
         :param virtual: if set True, when saving this config, none of the loaded fields is saved. Parameter virtual serves
         as a way to add useful values to the config that we don't want to save
         :type virtual: bool
+        :param cache: keep the parsed fields in a binary sidecar file next to the config (see cache_path) and load them
+        from it while the config is unchanged, None uses the cache setting of the ConfigFile
+        :type cache: bool
         :return: nothing
         :rtype:
         """
+        try:
+            self._load(filepath, overwrite, reload, virtual, cache)
+        finally:
+            self.changed()
+
+    def _load(self, filepath, overwrite, reload, virtual, cache):
         self.paths.append(filepath)
         if reload: self.fields = {}
-        with open(filepath, 'r') as f:
-            lines = f.readlines()
-            for line in lines:
-                line_nospace = line.replace(' ','').replace('\t','')
-                if line_nospace == '\n' or line_nospace.startswith('#'): continue # ignore empty lines or commented lines
-                field = ConfigField(line.replace('\n',''), virtual)
-                if field.name not in self.fields or overwrite: # set overwrite when you want to allow overwriting fields
-                    self.fields[field.name] = field
-                else:
-                    raise KeyError('The field {} is duplicate.'.format(field.name))
+        if cache is None: cache = self.cache
+        if cache:
+            key = self._cache_key(filepath)
+            table = self._read_cache(filepath, key)
+            if table is not None:
+                parser = ConfigField.value_parser
+                fields = self.fields
+                for name, dtype, value, spec, comment in table:
+                    if spec is not None: # function field, sampled again as when parsed from the text
+                        value = parser.parse_value(dtype, spec)
+                    field = ConfigField.__new__(ConfigField) # skips __init__, all attributes are set here
+                    field.virtual, field.used = virtual, False
+                    field.name, field.dtype, field.value, field.spec, field.comment = name, dtype, value, spec, comment
+                    if name in fields and not overwrite:
+                        raise KeyError('The field {} is duplicate.'.format(name))
+                    fields[name] = field
+                return
+        table = []
+        fields = self.fields
+        with open(filepath, 'r') as f: # streamed line by line, only the fields are kept
+            for lineno, line in enumerate(f, 1):
+                line = line.rstrip('\r\n')
+                stripped = line.lstrip(' \t')
+                if not stripped or stripped[0] == '#': continue # ignore empty lines or commented lines
+                try:
+                    field = ConfigField(line, virtual)
+                    if field.name in fields and not overwrite: # set overwrite when you want to allow overwriting fields
+                        raise KeyError('The field {} is duplicate.'.format(field.name))
+                except (AssertionError, KeyError, TypeError, ValueError) as e:
+                    location = '{}, line {}: '.format(filepath, lineno)
+                    if len(e.args) == 1 and isinstance(e.args[0], str): # the original error with the location
+                        e.args = (location + e.args[0],)
+                        raise
+                    raise ValueError(location + str(e)) # errors with structured args (UnicodeDecodeError)
+                fields[field.name] = field
+                if cache:
+                    table.append((field.name, field.dtype.value, field.value if field.spec is None else None,
+                                  field.spec, field.comment))
+        if cache:
+            self._write_cache(filepath, key, table)
+
+    @staticmethod
+    def cache_path(filepath):
+        """
+        Path of the cache sidecar of the config file, a hidden file in the same directory.
+        """
+        directory, name = os.path.split(os.path.abspath(filepath))
+        return os.path.join(directory, '.' + name + '.cache')
+
+    @staticmethod
+    def _cache_key(filepath): # identity of the config file content, the hash catches edits within the mtime resolution
+        stat = os.stat(filepath)
+        digest = hashlib.sha1()
+        with open(filepath, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        return (CACHE_VERSION, os.path.abspath(filepath), getattr(stat, 'st_mtime_ns', stat.st_mtime), stat.st_size,
+                digest.hexdigest())
+
+    @staticmethod
+    def _read_cache(filepath, key):
+        # cached table of fields, None when missing, stale or not valid. The sidecar is data only (marshal of tuples of
+        # plain values), the key in its header is checked before the table is read and every row is validated
+        try:
+            with open(ConfigFile.cache_path(filepath), 'rb') as f:
+                if f.read(len(CACHE_MAGIC)) != CACHE_MAGIC:
+                    return None
+                size, = struct.unpack('>I', f.read(4))
+                if marshal.loads(f.read(size)) != key:
+                    return None
+                rows = marshal.loads(f.read())
+        except Exception: # missing or broken sidecar is parsed again
+            return None
+        if not isinstance(rows, list):
+            return None
+        table = []
+        for row in rows:
+            if type(row) is not tuple or len(row) != 5:
+                return None
+            name, dtype, value, spec, comment = row
+            types = _CACHE_TYPES.get(dtype) if type(dtype) is str else None
+            if types is None or type(name) is not str or type(comment) is not str or \
+                    not (type(spec) is str if spec is not None else value is None or type(value) in types[1]):
+                return None
+            table.append((name, types[0], value, spec, comment))
+        return table
+
+    @staticmethod
+    def _write_cache(filepath, key, table):
+        path = ConfigFile.cache_path(filepath)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                header = marshal.dumps(key)
+                f.write(CACHE_MAGIC + struct.pack('>I', len(header)) + header)
+                f.write(marshal.dumps(table))
+            getattr(os, 'replace', os.rename)(tmp, path) # readers never see a partial sidecar
+        except (IOError, OSError): # read-only directory, the config is just parsed every time
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
 
     def save(self, filepath):
         with open(filepath, 'w') as f:
@@ -48,6 +160,16 @@ class ConfigFile(object):
                 raise KeyError('The field {} is already present. Set overwrite=True to overwrite all duplicates.'.format(field.name))
 
             self.fields[name] = field
+        self.changed(list(config_file.fields.keys()))
+
+    def changed(self, names=None):
+        """
+        Updates the LayeredConfigs that have this config as a layer after the fields of names (all when None) were
+        added or replaced. The methods of ConfigFile call it, call it after changing self.fields directly.
+        """
+        if self._layered is not None:
+            for layered in list(self._layered):
+                layered._layer_changed(self, names)
 
     def contains_field(self, name):
         return name in self.fields
@@ -66,12 +188,14 @@ class ConfigFile(object):
                            'has dtype {} while the current one {}.'\
                            .format(field.name, field.dtype, field_current.dtype))
         self.fields[field.name] = field
+        self.changed([field.name])
 
     def add_field_from_string(self, fieldstring, virtual=False):
         field = ConfigField(fieldstring.replace('\n',''), virtual)
         if field.name in self.fields:
             raise KeyError('The field {} is already present. Use set_field_from_string to overwrite it.'.format(field.name))
         self.fields[field.name] = field
+        self.changed([field.name])
 
     # set value of a field
     def set_value(self, field_name, value):
@@ -103,12 +227,75 @@ class ConfigFile(object):
             raise KeyError('The field {} is already present.'.format(name))
         field = ConfigField(virtual=virtual).init(name, dtype, value, comment)
         self.fields[name] = field
+        self.changed([name])
 
     def add_float(self, name, value, virtual=False, comment=''): self.add_field(name, ConfigFieldDtype.Float, value, virtual, comment)
     def add_int(self, name, value, virtual=False, comment=''): self.add_field(name, ConfigFieldDtype.Int, value, virtual, comment)
     def add_string(self, name, value, virtual=False, comment=''): self.add_field(name, ConfigFieldDtype.String, value, virtual, comment)
     def add_bool(self, name, value, virtual=False, comment=''): self.add_field(name, ConfigFieldDtype.Bool, value, virtual, comment)
 
+    def view(self, names=None, dtypes=None):
+        """
+        Returns frozen view of the fields with one attribute per field, reading a value is a plain attribute access
+        (e.g. view.learning_rate), so it suits hot loops better than get_float and others. The values are the ones at
+        the time of the call, the view doesn't follow later changes of the config. The first read of every attribute
+        marks the field as used for check_unused.
+        :param names: names of the fields in the view, all fields by default
+        :type names: list
+        :param dtypes: expected ConfigFieldDtype of the fields by name, checked once when the view is created
+        :type dtypes: dict
+        :return: instance of a class generated for the view
+        :rtype: ConfigView
+        """
+        fields = self._view_fields(names, dtypes)
+        return ConfigView.make_class(fields)._make([field.value for field in fields])
+
+    def sample(self, n, seed=None, names=None, dtypes=None):
+        """
+        Draws n variants of the config at once, the function fields (e.g. Uniform(0,1)) are sampled by a vectorized draw
+        of n values from a local numpy Generator, so the global numpy random state is not touched and the same seed
+        gives the same variants. The other fields have the same value in every variant.
+        :param n: number of variants
+        :type n: int
+        :param seed: seed of numpy.random.default_rng or a numpy Generator
+        :param names: names of the fields in the variants, all fields by default
+        :type names: list
+        :param dtypes: expected ConfigFieldDtype of the fields by name, as in view
+        :type dtypes: dict
+        :return: columns of the variants that can be iterated as views
+        :rtype: ConfigSamples
+        """
+        import numpy as np
+        rng = seed if isinstance(seed, np.random.Generator) else np.random.default_rng(seed)
+        fields = self._view_fields(names, dtypes)
+        parser = ConfigField.value_parser
+        columns = []
+        for field in fields:
+            if field.spec is None:
+                columns.append([field.value] * n) # one shared value
+            else:
+                spec = field.spec.replace(' ','').replace('\t','')
+                function = parser.function(spec)
+                if function is None:
+                    raise ValueError('The function of the field {} is not registered: {}'.format(field.name, field.spec))
+                columns.append(np.asarray(function.sample(field.dtype, spec, n, rng)).tolist()) # python scalars
+        return ConfigSamples(ConfigView.make_class(fields), columns, n)
+
+    def _view_fields(self, names, dtypes): # fields of a view, checked for presence, dtypes and valid names
+        names = list(self.fields.keys()) if names is None else list(names)
+        dtypes = dtypes or {}
+        fields = []
+        for name in names:
+            if name not in self.fields:
+                raise KeyError('The field {} is not present.'.format(name))
+            field = self.fields[name]
+            if name in dtypes and field.dtype is not dtypes[name]:
+                raise TypeError('The field {} is not of type {} but of type {}'.format(name, dtypes[name], field.dtype))
+            if not _IDENTIFIER.match(name) or keyword.iskeyword(name) or name.startswith('_'):
+                raise ValueError('The field {} is not a valid attribute name of a view.'.format(name))
+            fields.append(field)
+        return fields
+
     def check_unused(self): # checks if some fields were not used, can help to detect forgotten implementations of some parameters
         for _,field in self.fields.items():
             if not field.used:
@@ -133,12 +320,214 @@ class ConfigFile(object):
 
 
 
+class LayeredConfig(ConfigFile):
+    """
+    Stack of ConfigFile layers read as one config, the fields of later layers override the fields of earlier ones
+    (e.g. [base, environment, job]). The layers are not copied, self.fields is a flattened index of the winning fields
+    that is updated incrementally when a layer changes, so all the getters, view, sample and save of ConfigFile work
+    on it. The changes made through the LayeredConfig go to the top layer, the lower layers can be shared by many
+    LayeredConfigs.
+    """
+    def __init__(self, layers):
+        self.cache = False
+        self._layered = None
+        self._init(tuple(layers), {}, {})
+        for i, layer in enumerate(self.layers):
+            self.fields.update(layer.fields)
+            self._sources.update(dict.fromkeys(layer.fields, i))
+
+    def _init(self, layers, fields, sources):
+        if len(layers) == 0:
+            raise ValueError('LayeredConfig needs at least one layer.')
+        self.layers = layers
+        self.fields = fields
+        self._sources = sources # field name -> index of the layer that supplies it
+        for layer in layers:
+            if layer._layered is None:
+                layer._layered = weakref.WeakSet()
+            layer._layered.add(self)
+
+    def new_child(self, layer=None):
+        """
+        Returns LayeredConfig with the layers of this one and layer (new empty ConfigFile by default) on top, the index is
+        copied from this one instead of being built from all the layers.
+        """
+        layer = ConfigFile() if layer is None else layer
+        child = LayeredConfig.__new__(LayeredConfig)
+        child.cache = False
+        child._layered = None
+        child._init(self.layers + (layer,), dict(self.fields), dict(self._sources))
+        child.fields.update(layer.fields)
+        child._sources.update(dict.fromkeys(layer.fields, len(child.layers) - 1))
+        return child
+
+    @property
+    def paths(self):
+        return [path for layer in self.layers for path in layer.paths]
+
+    def source(self, name):
+        """
+        Returns the layer (ConfigFile) that supplies the value of field name.
+        """
+        return self.layers[self.layer_index(name)]
+
+    def layer_index(self, name):
+        if name not in self._sources:
+            raise KeyError('The field {} is not present.'.format(name))
+        return self._sources[name]
+
+    def _layer_changed(self, layer, names):
+        if names is None: # the fields of the layer and the ones it supplied before
+            names = set(layer.fields)
+            names.update(name for name, i in self._sources.items() if self.layers[i] is layer)
+        for name in names:
+            for i in range(len(self.layers) - 1, -1, -1):
+                field = self.layers[i].fields.get(name)
+                if field is not None:
+                    self.fields[name] = field
+                    self._sources[name] = i
+                    break
+            else: # not in any layer anymore
+                self.fields.pop(name, None)
+                self._sources.pop(name, None)
+        if self._layered is not None: # LayeredConfig used as a layer of another one
+            self.changed(list(names))
+
+    # changes go to the top layer, the fields of the lower layers are never modified
+    def load(self, filepath, overwrite=False, reload=False, virtual=False, cache=None):
+        self.layers[-1].load(filepath, overwrite, reload, virtual, cache)
+
+    def merge_with(self, config_file, overwrite=True):
+        self.layers[-1].merge_with(config_file, overwrite)
+
+    def set_field_from_string(self, fieldstring):
+        field = ConfigField(fieldstring.replace('\n',''))
+        if field.name not in self.fields:
+            raise KeyError('The field {} is not present.'.format(field.name))
+        if field.dtype is not self.fields[field.name].dtype:
+            raise KeyError('The data types are mismatching in the field {}. The setting field '
+                           'has dtype {} while the current one {}.'\
+                           .format(field.name, field.dtype, self.fields[field.name].dtype))
+        top = self.layers[-1]
+        top.fields[field.name] = field
+        top.changed([field.name])
+
+    def add_field_from_string(self, fieldstring, virtual=False):
+        field = ConfigField(fieldstring.replace('\n',''), virtual)
+        if field.name in self.fields:
+            raise KeyError('The field {} is already present. Use set_field_from_string to overwrite it.'.format(field.name))
+        top = self.layers[-1]
+        top.fields[field.name] = field
+        top.changed([field.name])
+
+    def add_field(self, name, dtype, value, virtual=False, comment=''):
+        if name in self.fields:
+            raise KeyError('The field {} is already present.'.format(name))
+        self.layers[-1].add_field(name, dtype, value, virtual, comment)
+
+    def set_value(self, field_name, value):
+        if field_name not in self.fields:
+            raise KeyError('The field {} is not present.'.format(field_name))
+        top = self.layers[-1]
+        if field_name in top.fields:
+            top.set_value(field_name, value)
+        else: # the field of a lower layer is overridden in the top layer
+            field = self.fields[field_name]
+            field.dtype.check_type_error(value)
+            top.add_field(field_name, field.dtype, value, field.virtual, field.comment)
+
+
+_IDENTIFIER = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+
+
+class _FirstRead(object):
+    # descriptor of a view attribute until its first read, marks the field used and replaces itself by the slot
+    __slots__ = ('field', 'slot')
+
+    def __init__(self, field, slot):
+        self.field = field
+        self.slot = slot
+
+    def __get__(self, view, cls):
+        if view is None:
+            return self
+        self.field.used = True
+        setattr(cls, self.field.name, self.slot) # next reads go straight to the slot
+        return self.slot.__get__(view, cls)
+
+
+class ConfigView(object):
+    """
+    Base of the frozen views created by ConfigFile.view. Every view gets its own class with a slot per field, the values
+    are read from the slots directly once each of them was read the first time.
+    """
+    __slots__ = ()
+
+    @staticmethod
+    def make_class(fields):
+        # class of the views of the fields, its instances are created by _make
+        slots = tuple('_v_' + field.name for field in fields)
+        cls = type('ConfigView', (ConfigView,), {'__slots__': slots, '_fields': tuple(field.name for field in fields)})
+        cls._setters = tuple(getattr(cls, slot).__set__ for slot in slots)
+        for field, slot in zip(fields, slots):
+            setattr(cls, field.name, _FirstRead(field, getattr(cls, slot)))
+        return cls
+
+    @classmethod
+    def _make(cls, values):
+        view = object.__new__(cls)
+        for setter, value in zip(cls._setters, values):
+            setter(view, value)
+        return view
+
+    def __setattr__(self, name, value):
+        raise AttributeError('The config view is frozen, set the value in the ConfigFile and create a new view.')
+
+    def __delattr__(self, name):
+        raise AttributeError('The config view is frozen.')
+
+    def _asdict(self): # doesn't mark the fields used
+        return dict((name, getattr(self, '_v_' + name)) for name in self._fields)
+
+    def __repr__(self):
+        return 'ConfigView({})'.format(', '.join('{}={!r}'.format(name, getattr(self, '_v_' + name))
+                                                 for name in self._fields))
+
+
+class ConfigSamples(object):
+    """
+    Variants of a config drawn by ConfigFile.sample, stored as columns (field name -> list of n values). Iterating or
+    indexing gives frozen views of the variants, created on demand.
+    """
+    def __init__(self, view_class, columns, n):
+        self.view_class = view_class
+        self.columns = dict(zip(view_class._fields, columns))
+        self._columns = columns
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, i):
+        if i < 0: i += self.n
+        if not 0 <= i < self.n:
+            raise IndexError('variant {} out of {}'.format(i, self.n))
+        return self.view_class._make([column[i] for column in self._columns])
+
+    def __iter__(self):
+        make = self.view_class._make
+        for values in (zip(*self._columns) if self._columns else [()] * self.n):
+            yield make(values)
+
+
 class ConfigField(object):
+    __slots__ = ('name', 'dtype', 'value', 'comment', 'spec', 'virtual', 'used')
+
     def __init__(self, parsestring=None, virtual=False): # virtual property decides whether the field is saved into file
-        self.value_parser = ConfigValueParser()
         self.virtual = virtual
         self.used = False
         self.comment = ''
+        self.spec = None # function string (e.g. "Uniform(0,1)") the value was sampled from
         if parsestring is not None:
             self.parse(parsestring)
 
@@ -151,15 +540,16 @@ class ConfigField(object):
         return self
 
     def parse(self, parsestring):
-        parts = parsestring.split(';')
+        parts = parsestring.split(';', 3)
         assert len(parts) >= 3, 'each config field string has to have 3 parts. [{}]'.format(parsestring)
         self.name = parts[0]
-        self.dtype = ConfigFieldDtype(parts[1])
-        split = parts[2].split('#')
+        self.dtype = _DTYPES.get(parts[1]) or ConfigFieldDtype(parts[1]) # enum raises the error of unknown dtype
+        split = parts[2].split('#', 2)
         if len(split) > 1:
             self.comment = split[1]
-        parts[2] = split[0]
-        self.value = self.value_parser.parse_value(self.dtype, parts[2])
+        self.value, function = self.value_parser.parse(self.dtype, split[0])
+        if function is not None:
+            self.spec = split[0]
 
     def __str__(self):
         return (self.name + ';' + self.dtype.value + ';' + str(self.value) + '#' + self.comment)
@@ -189,6 +579,12 @@ class ConfigFieldDtype(Enum):
         if self.value == 'string':
             if not isinstance(value, str): raise TypeError('The value "{}" is not of type string.'.format(value))
 
+_DTYPES = dict((dtype.value, dtype) for dtype in ConfigFieldDtype)
+
+# dtype value -> (dtype, types of the values) of the rows of the cache sidecar
+_CACHE_TYPES = {'bool': (ConfigFieldDtype.Bool, (bool,)), 'float': (ConfigFieldDtype.Float, (float,)),
+                'int': (ConfigFieldDtype.Int, (int, bool)), 'string': (ConfigFieldDtype.String, (str,))}
+
 def parse_bool(valuestring):
     if valuestring.lower() in ['true', '1'] :
         return True
@@ -199,34 +595,49 @@ def parse_bool(valuestring):
 
 class ConfigValueParser(object):
     def __init__(self):
-        self.functions = [LogUniform(), Uniform(), RandomBool()]
+        self.functions = {} # name -> function, looked up by the text before "("
+        for function in [LogUniform(), Uniform(), RandomBool()]:
+            self.functions[function.name] = function
+
+    def register(self, function):
+        """
+        Adds ConfigFunction (an instance of its subclass), the values of the fields with its name are generated by it.
+        """
+        self.functions[function.name] = function
 
     def parse_value(self, dtype, valuestring):
-        valuestring2 = valuestring.replace(' ','').replace('\t','')
-        fun_value = self._check_functions(dtype, valuestring2)
+        return self.parse(dtype, valuestring)[0]
+
+    def parse(self, dtype, valuestring):
+        """
+        Returns (value, function) parsed from valuestring, function is the ConfigFunction that generated the value or None
+        for plain values.
+        """
         if dtype is ConfigFieldDtype.String: # return plain string
-            return valuestring
-        elif fun_value is not None: # return function value if found
-            return fun_value
+            return valuestring, None
+        valuestring2 = valuestring.replace(' ','').replace('\t','')
+        function = self.function(valuestring2)
+        if function is not None: # return function value if found
+            return function.parsevalue(dtype, valuestring2), function
 
         if valuestring2 == 'None':
-            return None
+            return None, None
         # in the rest of the cases simply try to parse the string as given datatype
         if dtype is ConfigFieldDtype.Bool:
-            return parse_bool(valuestring2) # have to use proprietary func as python built-in parses all non-empty strings as true
+            return parse_bool(valuestring2), None # have to use proprietary func as python built-in parses all non-empty strings as true
         elif dtype is ConfigFieldDtype.Int:
-            return int(valuestring2)
+            return int(valuestring2), None
         elif dtype is ConfigFieldDtype.Float:
-            return float(valuestring2)
+            return float(valuestring2), None
         else:
             raise NotImplementedError('Dtype {} has not been implemented'.format(dtype))
 
-    def _check_functions(self, dtype, valuestring):
-        for function in self.functions:
-            if function.is_instance(valuestring):
-                return function.parsevalue(dtype, valuestring)
-
-        return None
+    def function(self, valuestring): # function of the valuestring without whitespace, None for plain values
+        i = valuestring.find('(')
+        if i < 0:
+            return None
+        function = self.functions.get(valuestring[:i])
+        return function if function is not None and function.is_instance(valuestring) else None
 
 
 class ConfigFunction(object):
@@ -245,6 +656,26 @@ class ConfigFunction(object):
         """
         pass
 
+    def sample(self, dtype, valuestring, n, rng):
+        """
+        Returns n values generated according to the function definition by numpy Generator rng, as a numpy array or
+        a list. Used by ConfigFile.sample, the functions that don't implement it can't be sampled in batches.
+        :param dtype:
+        :type dtype: ConfigFieldDtype
+        :param valuestring: function definition without whitespace
+        :type valuestring: str
+        :param n: number of values
+        :type n: int
+        :param rng:
+        :type rng: numpy.random.Generator
+        :return:
+        :rtype: numpy.ndarray
+        """
+        raise NotImplementedError('{} function does not support sampling'.format(self.name))
+
+    def arguments(self, valuestring): # argument strings of the function definition
+        return valuestring[len(self.name) + 1:valuestring.rindex(')')].split(',')
+
     def is_instance(self, valuestring):
         """
         Returns true if parsestring represents instance of this function
@@ -265,11 +696,20 @@ class LogUniform(ConfigFunction):
             values = valuestring.replace('LogUniform(','').replace(')','').split(',')
             a = float(values[0])
             b = float(values[1])
+            import numpy as np # imported on the first use, importing ezconfig stays cheap
             value = float(np.exp(np.random.uniform(np.log(a), np.log(b))))
             return value
         else:
             raise TypeError('LogUniform function does not support type {}'.format(dtype))
 
+    def sample(self, dtype, valuestring, n, rng):
+        if dtype is ConfigFieldDtype.Float:
+            values = self.arguments(valuestring)
+            import numpy as np
+            return np.exp(rng.uniform(np.log(float(values[0])), np.log(float(values[1])), n))
+        else:
+            raise TypeError('LogUniform function does not support type {}'.format(dtype))
+
 class Uniform(ConfigFunction):
     def __init__(self):
         ConfigFunction.__init__(self, 'Uniform')
@@ -279,17 +719,28 @@ class Uniform(ConfigFunction):
             values = valuestring.replace('Uniform(','').replace(')','').split(',')
             a = float(values[0])
             b = float(values[1])
+            import numpy as np
             value = float(np.random.uniform(a,b))
             return value
         elif dtype is ConfigFieldDtype.Int: # uniform for int is inclusive of both points
             values = valuestring.replace('Uniform(','').replace(')','').split(',')
             a = int(values[0])
             b = int(values[1])
-            value = int(np.random.choice(np.arange(a,b+1)))
+            import numpy as np
+            value = int(np.random.randint(a, b+1)) # no array of the whole range
             return value
         else:
             raise TypeError('Uniform function does not support type {}'.format(dtype))
 
+    def sample(self, dtype, valuestring, n, rng):
+        values = self.arguments(valuestring)
+        if dtype is ConfigFieldDtype.Float:
+            return rng.uniform(float(values[0]), float(values[1]), n)
+        elif dtype is ConfigFieldDtype.Int: # inclusive of both points
+            return rng.integers(int(values[0]), int(values[1]), n, endpoint=True)
+        else:
+            raise TypeError('Uniform function does not support type {}'.format(dtype))
+
 class RandomBool(ConfigFunction):
     def __init__(self):
         ConfigFunction.__init__(self, 'RandomBool')
@@ -297,10 +748,26 @@ class RandomBool(ConfigFunction):
     def parsevalue(self, dtype, valuestring):
         if dtype is ConfigFieldDtype.Bool:
             p_true = float(valuestring.replace('RandomBool(','').replace(')',''))
+            import numpy as np
             return np.random.rand() < p_true
         else:
             raise TypeError('RandomBool function does not support type {}'.format(dtype))
 
+    def sample(self, dtype, valuestring, n, rng):
+        if dtype is ConfigFieldDtype.Bool:
+            return rng.random(n) < float(self.arguments(valuestring)[0])
+        else:
+            raise TypeError('RandomBool function does not support type {}'.format(dtype))
+
+ConfigField.value_parser = ConfigValueParser() # shared by all fields, the parser has no state except the functions
+
+
+def register_function(function):
+    """
+    Registers ConfigFunction in the parser of all config files, see ConfigValueParser.register.
+    """
+    ConfigField.value_parser.register(function)
+
 if __name__ == '__main__':
 
     dtype = ConfigFieldDtype.Bool
@@ -1,112 +1,1209 @@
-import pprint
-from collections import OrderedDict
-from ezconfig import ConfigFile
+import atexit
+from collections import OrderedDict, deque
+from ezconfig import ConfigFile, parse_bool
+import copy
+import functools
 import inspect
+import os
+import sys
+import threading
+import time
 import types
+import itertools
+import weakref
+from array import array
+try:
+    from contextvars import ContextVar
+except ImportError: # python < 3.7, the state is local to threads only
+    class ContextVar(object):
+        def __init__(self, name, default=None):
+            self.name = name
+            self.default = default
+            self.local = threading.local()
+
+        def get(self):
+            return getattr(self.local, 'value', self.default)
+
+        def set(self, value):
+            self.local.value = value
+_clock = getattr(time, 'perf_counter', time.time)
+if hasattr(time, 'perf_counter_ns'):
+    _clock_ns = time.perf_counter_ns
+    _cpu_clock_ns = getattr(time, 'thread_time_ns', time.process_time_ns)
+else: # python < 3.7
+    _clock_ns = lambda: int(_clock() * 1e9)
+    _cpu_clock_ns = lambda: int(getattr(time, 'process_time', time.clock)() * 1e9)
+try:
+    from reprlib import Repr
+except ImportError: # python 2.x
+    from repr import Repr
+
+class _IndexNode(object):
+    """
+    Immutable position of a JsonIndex. It keeps a direct reference to the container (value) it points to.
+    """
+    __slots__ = ('parent', 'key', 'value', 'depth', 'first')
+
+    def __init__(self, parent, key, value, depth, first):
+        self.parent = parent
+        self.key = key
+        self.value = value
+        self.depth = depth
+        self.first = first # the first index of the path
+
 
 class JsonIndex(object):
+    """
+    Cursor into a nested json structure. The position of the cursor is local to the thread and asyncio task (context)
+    that moves it, a new thread starts at the reset position and a new task at the position of the context it was
+    created from. Positions are immutable nodes that reference the containers directly, so getting the head, going
+    deeper or higher costs the same at any depth.
+    """
     def __init__(self, json, reset=True):
-        self.indices = [] # scope
-        # self.types = []
         self.json = json
+        self._var = ContextVar('json_index', default=_IndexNode(None, None, json, 0, None))
         if reset:
             self.reset()
-
-    def reset(self):
-        self.indices = []
-        if isinstance(self.json, OrderedDict) and len(self.json) > 0:
-            self.indices.append(list(self.json.keys())[0])
+            self._var = ContextVar('json_index', default=self._var.get()) # new threads start at the reset position
+
+    def reset(self, index=None):
+        """
+        Moves the cursor back to the root. If index is given, it goes deeper into the index, otherwise into the first
+        element of the root (if there is any).
+        """
+        self._var.set(_IndexNode(None, None, self.json, 0, None))
+        if index is not None:
+            self.deeper(index)
+        elif isinstance(self.json, OrderedDict) and len(self.json) > 0:
+            self.deeper(next(iter(self.json)))
         elif isinstance(self.json, list) and len(self.json) > 0:
-            self.indices.append(0)
+            self.deeper(0)
 
-    # def _sync_types(self):
-    #     o = self.json
-    #     self.types = []
-    #     for ix in self.indices:
-    #         self.types.append(type())
+    @property
+    def indices(self): # scope
+        indices = []
+        node = self._var.get()
+        while node.parent is not None:
+            indices.append(node.key)
+            node = node.parent
+        return indices[::-1]
 
     def get_value(self):
-        o = self.json
-        for ix in self.indices:
-            o = o[ix]
-            # print(o)
-        return o
+        return self._var.get().value
+
+    def position(self):
+        return self._var.get()
 
     def copy(self):
         index = JsonIndex(self.json, reset=False)
-        index.indices = self.indices
+        index._var = ContextVar('json_index', default=self._var.get())
+        return index
 
     def is_head_dict(self):
-        return isinstance(self.get_value(), OrderedDict)
+        return isinstance(self._var.get().value, OrderedDict)
 
     def is_head_list(self):
-        return isinstance(self.get_value(), list)
-        
+        return isinstance(self._var.get().value, list)
+
     def deeper(self, index):
-        # ix = self.copy()
-        self.indices.append(index)
+        node = self._var.get()
+        self._var.set(_IndexNode(node, index, node.value[index], node.depth + 1,
+                                 node.first if node.depth > 0 else index))
 
     def higher(self):
-        return self.indices.pop(-1)
+        node = self._var.get()
+        self._var.set(node.parent)
+        return node.key
 
     def first_index(self):
-        return self.indices[0]
+        node = self._var.get()
+        if node.depth == 0:
+            raise IndexError('the index is at the root')
+        return node.first
 
     def __len__(self):
-        return len(self.indices)
+        return self._var.get().depth
 
     def depth(self):
         return len(self)
 
 
+class _Collapsed(object):
+    # marker of the items of a container that are not rendered
+    __slots__ = ('text',)
+
+    def __init__(self, text):
+        self.text = text
+
+
+class _FlushView(OrderedDict):
+    # ancestors of the flushed records, only the flushed part of them
+    pass
+
+
 class JsonPrinter(object):
-    def __init__(self, ncols=80, nindents=2, nlistcollapse=6, ndictcollapse=10):
+    # how the collapsed items of a dict are called by the key of the dict, 'items' otherwise
+    COLLAPSED_NAMES = {'calls': 'calls', 'print': 'prints'}
+
+    def __init__(self, ncols=80, nindents=2, nlistcollapse=6, ndictcollapse=10, formatter=str):
+        """
+        :param ncols: containers of leaf values that fit into ncols are rendered on a single line, None to disable
+        :param nlistcollapse: only the first nlistcollapse items of longer lists are rendered, None to disable
+        :param ndictcollapse: only the first ndictcollapse items of larger dicts are rendered, None to disable
+        """
         self.ncols = ncols
         self.nindents = nindents
         self.nlistcollapse = nlistcollapse
         self.ndictcollapse = ndictcollapse
+        self.formatter = formatter # turns the leaf values into strings
 
-    def jprint(self, json):
-        print(self.jstr(json))
+    def jprint(self, json, out=None):
+        out = sys.stdout if out is None else out
+        self.write(json, out)
+        out.write('\n')
 
     def jstr(self, json):
-        return self._jstr(json, 0, self.ncols)
-
-    def _jstr(self, json, indent=0, remaining=0):
-        t = ' '*indent
+        return ''.join(self.iter_chunks(json))
+
+    def write(self, json, out, bufsize=1 << 16):
+        """
+        Renders json into the file-like object out in a single pass. Chunks are buffered up to bufsize characters, the
+        whole output string is never held in memory.
+        """
+        buf = []
+        size = 0
+        for chunk in self.iter_chunks(json):
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= bufsize:
+                out.write(''.join(buf))
+                buf = []
+                size = 0
+        if buf:
+            out.write(''.join(buf))
+
+    def iter_chunks(self, json):
+        """
+        Generates the rendered json chunk by chunk. The structure is walked with an explicit stack, so the cost is
+        linear in the size of the output and deep structures don't hit the recursion limit. Collapsed items are never
+        visited.
+        """
         nl = '\n'
-        if isinstance(json, list):
-            s = '['
-            if len(json) > 0: s += nl + t
-            for i,val in enumerate(json):
-                s += self._jstr(val, indent+self.nindents)
-                if i < len(json)-1:
-                    s += ',' + nl + t
-            if len(json) > 0: s += nl + t
-            s += ']'
-        elif isinstance(json, dict) or isinstance(json, OrderedDict):
-            s = '{'
-            if len(json) > 0: s += nl + t
-            for i,(key, val) in enumerate(list(json.items())):
-                s += str(key) + ': ' + self._jstr(val, indent+self.nindents)
-                if i < len(json)-1:
-                    s += ',' + nl + t
-            if len(json) > 0: s += nl + t
-            s += '}'
+        end = object()
+        stack = [] # [items iterator, indent string, is dict, is first item, closing bracket] for each open container
+        value, indent, column, key = json, 0, 0, None
+        while True:
+            if isinstance(value, list) or isinstance(value, dict):
+                line = self._one_line(value, key, self.ncols - column) if self.ncols is not None else None
+                if line is not None:
+                    yield line
+                else:
+                    is_dict = isinstance(value, dict)
+                    items = self._head(value, key) # copy, the json may grow while rendering
+                    yield '{' if is_dict else '['
+                    if len(items) > 0:
+                        t = ' '*indent
+                        yield nl + t
+                        stack.append([iter(items), t, is_dict, True, '}' if is_dict else ']'])
+                    else:
+                        yield '}' if is_dict else ']'
+            else:
+                yield self.formatter(value)
+
+            # find next value to render, close all exhausted containers
+            while len(stack) > 0:
+                frame = stack[-1]
+                item = next(frame[0], end)
+                if item is end:
+                    stack.pop()
+                    yield nl + frame[1] + frame[4]
+                    continue
+                if not frame[3]:
+                    yield ',' + nl + frame[1]
+                frame[3] = False
+                if isinstance(item, _Collapsed):
+                    yield item.text
+                    continue
+                if frame[2]:
+                    key, value = item
+                    key = str(key)
+                    yield key + ': '
+                    column = len(frame[1]) + len(key) + 2
+                else:
+                    key, value = None, item
+                    column = len(frame[1])
+                indent = len(frame[1]) + self.nindents
+                break
+            else:
+                return
+
+    def _head(self, value, key):
+        # list of the rendered items of the container, ended by _Collapsed marker when some items are collapsed
+        is_dict = isinstance(value, dict)
+        limit = self.ndictcollapse if is_dict else self.nlistcollapse
+        if limit is None or len(value) <= limit:
+            return list(value.items()) if is_dict else list(value)
+        items = list(itertools.islice(value.items() if is_dict else value, limit))
+        hidden = len(value) - limit
+        name = self.COLLAPSED_NAMES.get(key, 'items') if is_dict else 'items'
+        items.append(_Collapsed('... {:,} more {}'.format(hidden, name if hidden > 1 else name[:-1])))
+        return items
+
+    def _one_line(self, value, key, remaining):
+        # the container rendered on a single line if it holds only leaf values (or empty containers) and fits into
+        # remaining characters, None otherwise
+        if len(value) == 0:
+            return '{}' if isinstance(value, dict) else '[]'
+        if 3*min(len(value), self.ndictcollapse or len(value), self.nlistcollapse or len(value)) > remaining:
+            return None # every item takes at least 3 characters
+        is_dict = isinstance(value, dict)
+        parts = []
+        size = 2
+        for item in self._head(value, key):
+            if isinstance(item, _Collapsed):
+                s = item.text
+            else:
+                k, v = item if is_dict else (None, item)
+                if isinstance(v, list) or isinstance(v, dict):
+                    if len(v) > 0:
+                        return None
+                    s = '{}' if isinstance(v, dict) else '[]'
+                else:
+                    s = self.formatter(v)
+                    if '\n' in s:
+                        return None
+                if is_dict:
+                    s = str(k) + ': ' + s
+            size += len(s) + (2 if parts else 0)
+            if size > remaining:
+                return None
+            parts.append(s)
+        return ('{' if is_dict else '[') + ', '.join(parts) + ('}' if is_dict else ']')
+
+
+class LazyValue(object):
+    """
+    Value captured by reference (or as a shallow copy), it is formatted only when the json is printed.
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return str(self.value)
+
+
+class ValueFormatter(object):
+    """
+    Formats captured values within a budget of characters and container items, similar to reprlib. Large values of
+    the types with a registered summarizer (numpy arrays, sequences, mappings) are summarized instead, within a time
+    budget of max_seconds.
+    """
+    # type (or "module.QualName" of types that are not imported) -> handler(value, formatter) that returns the summary
+    # of the value or None when the value is small enough to be formatted as usual
+    SUMMARIZERS = {}
+    _version = 0 # increased by register, the formatters drop their cache of handlers
+
+    def __init__(self, max_chars=200, max_items=20, max_seconds=0.01):
+        self.max_chars = max_chars
+        self.max_items = max_items
+        self.max_seconds = max_seconds
+        self.max_stat_items = 1000000 # statistics of larger arrays are computed from a strided sample
+        self.deadline = None
+        self.repr = Repr()
+        self.repr.maxlist = self.repr.maxtuple = self.repr.maxset = self.repr.maxfrozenset = self.repr.maxdeque = \
+            self.repr.maxarray = self.repr.maxdict = max_items
+        self.repr.maxstring = self.repr.maxother = self.repr.maxlong = max_chars
+        self._handlers = {}
+        self._handlers_version = ValueFormatter._version
+        self.version = None # version of the FastPrint flags the formatter was created for
+
+    @classmethod
+    def register(cls, type_, handler=None):
+        """
+        Registers summarizer handler(value, formatter) of the values of type_ (and its subclasses), type_ can be the
+        "module.QualName" string of a type, so that its module doesn't have to be imported. Works as a decorator when
+        handler is not given.
+        """
+        def decorator(handler):
+            cls.SUMMARIZERS[type_] = handler
+            ValueFormatter._version += 1
+            return handler
+        return decorator if handler is None else decorator(handler)
+
+    def handler(self, value):
+        if self._handlers_version != ValueFormatter._version:
+            self._handlers = {}
+            self._handlers_version = ValueFormatter._version
+        t = type(value)
+        try:
+            return self._handlers[t]
+        except KeyError:
+            pass
+        handler = None
+        for klass in t.__mro__:
+            handler = self.SUMMARIZERS.get(klass) or \
+                self.SUMMARIZERS.get(klass.__module__ + '.' + getattr(klass, '__qualname__', klass.__name__))
+            if handler is not None:
+                break
+        self._handlers[t] = handler
+        return handler
+
+    def summary(self, value):
+        # summary of value within the current deadline, for the handlers that summarize the items of containers
+        handler = self.handler(value)
+        if handler is None:
+            return None
+        try:
+            return handler(value, self)
+        except Exception as e: # the summary must not break the traced code
+            return '<{} summary failed: {}>'.format(type(value).__name__, e)
+
+    def expired(self):
+        return self.deadline is not None and _clock() > self.deadline
+
+    def item(self, value):
+        # short representation of an item of a summarized container, the large items are summarized themselves
+        if type(value) not in _PLAIN_TYPES:
+            summary = self.summary(value)
+            if summary is not None:
+                return summary
+        return self.repr.repr(value)
+
+    def summarize(self, value):
+        """
+        Returns the summary of value if it has a summarizer and is large, None otherwise.
+        """
+        if self.handler(value) is None:
+            return None
+        self.deadline = _clock() + self.max_seconds if self.max_seconds > 0 else None
+        s = self.summary(value)
+        if s is not None and len(s) > self.max_chars:
+            s = s[:max(self.max_chars - 3, 0)] + '...'
+        return s
+
+    def __call__(self, value):
+        if isinstance(value, LazyValue):
+            value = value.value
+        if isinstance(value, str):
+            s = value
         else:
-            s = str(json)
+            s = self.summarize(value)
+            if s is not None:
+                return s
+            if isinstance(value, (list, tuple, dict, set, frozenset, deque)):
+                s = self.repr.repr(value)
+            else:
+                s = str(value)
+        if len(s) > self.max_chars:
+            s = s[:max(self.max_chars - 3, 0)] + '...'
         return s
 
 
+_PLAIN_TYPES = frozenset([str, int, float, bool, type(None)]) # formatted by str, never summarized
+
+
+def _join_items(items, n, formatter):
+    # first items within the character and time budget, "..." ends the items that don't fit
+    parts = []
+    size = 0
+    for item in items:
+        if parts and (len(parts) >= formatter.max_items or size > formatter.max_chars or formatter.expired()):
+            break
+        parts.append(formatter.item(item))
+        size += len(parts[-1]) + 2
+    return ', '.join(parts) + (', ...' if len(parts) < n else '')
+
+
+def _summarize_small(value, formatter, keys=False):
+    # small container with summaries of its large items (the top level only), None if no item is large
+    handler = formatter.handler
+    if all(handler(v) is None for v in (value.values() if keys else value)): # plain items, formatted as usual
+        return None
+    items = list(value.items()) if keys else list(value)
+    summaries = [formatter.summary(v[1] if keys else v) for v in items]
+    if all(summary is None for summary in summaries):
+        return None
+    parts = [formatter.repr.repr(v[1] if keys else v) if summary is None else summary
+             for v, summary in zip(items, summaries)]
+    if keys:
+        return '{' + ', '.join(formatter.item(v[0]) + ': ' + p for v, p in zip(items, parts)) + '}'
+    if isinstance(value, tuple):
+        return '(' + ', '.join(parts) + (',)' if len(parts) == 1 else ')')
+    return '[' + ', '.join(parts) + ']'
+
+
+@ValueFormatter.register(list)
+@ValueFormatter.register(tuple)
+@ValueFormatter.register(deque)
+@ValueFormatter.register(set)
+@ValueFormatter.register(frozenset)
+def _summarize_sequence(value, formatter):
+    if len(value) <= formatter.max_items:
+        return _summarize_small(value, formatter) if isinstance(value, (list, tuple)) else None
+    return '{} len={} [{}]'.format(type(value).__name__, len(value), _join_items(value, len(value), formatter))
+
+
+@ValueFormatter.register(dict)
+def _summarize_mapping(value, formatter):
+    if len(value) <= formatter.max_items:
+        return _summarize_small(value, formatter, keys=True)
+    return '{} len={} keys=[{}]'.format(type(value).__name__, len(value), _join_items(value, len(value), formatter))
+
+
+@ValueFormatter.register('numpy.ndarray')
+def _summarize_ndarray(value, formatter):
+    if value.size <= formatter.max_items:
+        return None
+    flat = value.reshape(-1)
+    s = 'ndarray shape={} dtype={}'.format(value.shape, value.dtype)
+    if value.dtype.kind in 'biuf' and not formatter.expired():
+        sample = flat if flat.size <= formatter.max_stat_items else flat[::flat.size // formatter.max_stat_items + 1]
+        s += ' min={} max={} mean={:.6g}{}'.format(sample.min(), sample.max(), float(sample.mean()),
+                                                   '' if sample is flat else ' (sampled)')
+    return s + ' head=[{}]'.format(_join_items(flat[:formatter.max_items].tolist(), flat.size, formatter))
+
+
+class ArgBinder(object):
+    """
+    Maps the arguments of a call of func to an OrderedDict of parameter names and values. All the introspection
+    (argument names, defaults, *args, **kwargs) is done once when the binder is constructed, so that calling the
+    binder costs no more than building the dictionary itself.
+    """
+    NOT_DEFINED = 'ParameterNotDefined-Error, please report'
+
+    def __init__(self, func, skip_first=None):
+        """
+        :param skip_first: hide the first parameter (self or cls of methods), guessed from the name self when None
+        :type skip_first: bool
+        """
+        try:
+            if sys.version_info >= (3,0):
+                argspec = inspect.getfullargspec(func)
+                kwonlyargs, kwonlydefaults = argspec.kwonlyargs, argspec.kwonlydefaults or {}
+            else:
+                argspec = inspect.getargspec(func) # Works only for python 2.x
+                kwonlyargs, kwonlydefaults = [], {}
+        except TypeError: # builtins and other callables without introspectable signature
+            self.names = ()
+            self.skip = 0
+            self.defaults = {}
+            self.varargs, self.varkw = 'args', 'kwargs'
+            self.kwonlyargs, self.kwonlydefaults = (), {}
+            self.named = frozenset()
+            return
+
+        args, varargs, varkw, defaults = argspec[:4]
+        self.skip = 0 # number of leading positional values that are not shown (self of unbound methods)
+        if skip_first is None:
+            skip_first = inspect.ismethod(func) or (len(args) > 0 and args[0] == 'self')
+        if len(args) > 0 and skip_first:
+            if not inspect.ismethod(func): # self is passed explicitly with the call
+                self.skip = 1
+            args = args[1:]
+
+        defaults = defaults if defaults is not None else ()
+        self.names = tuple(args)
+        self.defaults = dict(zip(self.names[len(self.names)-len(defaults):], defaults))
+        self.varargs = varargs
+        self.varkw = varkw
+        self.kwonlyargs = tuple(kwonlyargs)
+        self.kwonlydefaults = dict(kwonlydefaults)
+        self.named = frozenset(self.names + self.kwonlyargs)
+
+    def __call__(self, fargs, fkwargs):
+        # arguments consistency does not need to be checked
+        # because python raises exception on calls with invalid
+        # arguments implicitly
+        if self.skip:
+            fargs = fargs[self.skip:]
+        names = self.names
+        nargs = len(names)
+
+        # unnamed function arguments
+        d = OrderedDict(zip(names, fargs))
+        # keyword arguments or default values otherwise
+        for name in names[len(fargs):]:
+            d[name] = fkwargs[name] if name in fkwargs else self.defaults.get(name, self.NOT_DEFINED)
+
+        # fill in *args
+        if self.varargs is not None:
+            d[self.varargs] = list(fargs[nargs:])
+
+        for name in self.kwonlyargs:
+            d[name] = fkwargs[name] if name in fkwargs else self.kwonlydefaults.get(name, self.NOT_DEFINED)
+
+        # fill in **kwargs
+        if self.varkw is not None:
+            d[self.varkw] = {key:val for key,val in fkwargs.items() if key not in self.named} if fkwargs else {}
+
+        return d
+
+
+class EventLog(object):
+    """
+    Append-only log of the trace events (call enter, call exit and print), the compact storage engine of FastPrint.
+    Events are stored in preallocated chunks of typed arrays, names are interned and values are kept in a value table
+    aligned with the events. The nested json is rebuilt from the log only when it is printed or exported.
+
+    Ids of the events come from an atomic counter and chunks never move, so threads append without a lock. The kind
+    is written last, an event with kind 0 is not complete yet.
+    """
+    ENTER, EXIT, PRINT = 1, 2, 3 # lower bits of the kind
+    ARGS, CALLS, RETVAL, LAZY, DROPPED, TIMED = 4, 8, 16, 32, 64, 128 # flags of the kind of the enter event
+    KIND_MASK = 3
+    TOP_PRINT, TOP_CALLS = -1, -2 # parents of top-level events, the "print" and the "calls" section
+    CHUNK_BITS = 14
+    CHUNK_SIZE = 1 << CHUNK_BITS
+    NO_VALUE = None
+
+    def __init__(self, names):
+        self.names = names # interned names, shared with FastPrint
+        self.chunks = [] # [kinds, parents, names, values]
+        self.parent = ContextVar('event_parent', default=self.TOP_PRINT) # the enter event of the call in progress
+        self._ids = itertools.count()
+        self._lock = threading.Lock() # guards only the allocation of new chunks
+        self._builder = None
+        self.released = 0 # the values of the events before are released
+
+    def _allocate(self, chunk):
+        with self._lock:
+            while len(self.chunks) <= chunk:
+                self.chunks.append([array('B', bytes(self.CHUNK_SIZE)) if sys.version_info >= (3,0) else
+                                    array('B', [0]) * self.CHUNK_SIZE,
+                                    array('q', [0]) * self.CHUNK_SIZE,
+                                    array('i', [0]) * self.CHUNK_SIZE,
+                                    [None] * self.CHUNK_SIZE])
+
+    def append(self, kind, parent, name, value):
+        i = next(self._ids)
+        c = i >> self.CHUNK_BITS
+        if c >= len(self.chunks):
+            self._allocate(c)
+        kinds, parents, names, values = self.chunks[c]
+        j = i & (self.CHUNK_SIZE - 1)
+        parents[j] = parent
+        names[j] = name
+        values[j] = value
+        kinds[j] = kind
+        return i
+
+    def kind(self, i):
+        return self.chunks[i >> self.CHUNK_BITS][0][i & (self.CHUNK_SIZE - 1)]
+
+    def parent_of(self, i):
+        return self.chunks[i >> self.CHUNK_BITS][1][i & (self.CHUNK_SIZE - 1)]
+
+    def enter(self, kind, name, value):
+        parent = self.parent.get()
+        i = self.append(kind, self.TOP_CALLS if parent == self.TOP_PRINT else parent, name, value)
+        self.parent.set(i)
+        return i
+
+    def exit(self, i, value, drop=False, calltime=None):
+        parent = self.parent_of(i)
+        self.parent.set(parent) # top-level prints go to calls after the first call, as in the tree backend
+        kinds = self.chunks[i >> self.CHUNK_BITS][0]
+        if drop:
+            kinds[i & (self.CHUNK_SIZE - 1)] |= self.DROPPED
+        if calltime is not None:
+            kinds[i & (self.CHUNK_SIZE - 1)] |= self.TIMED
+            value = (value, calltime)
+        self.append(self.EXIT, i, 0, value)
+
+    def record(self, name, value):
+        self.append(self.PRINT, self.parent.get(), name, value)
+
+    def iter_events(self, start=0):
+        """
+        Generates (id, kind, parent, name, value) of the complete events from start on.
+        """
+        i = start
+        while (i >> self.CHUNK_BITS) < len(self.chunks):
+            kinds, parents, names, values = self.chunks[i >> self.CHUNK_BITS]
+            j = i & (self.CHUNK_SIZE - 1)
+            kind = kinds[j]
+            if kind == 0:
+                return
+            yield i, kind, parents[j], names[j], values[j]
+            i += 1
+
+    def tree(self):
+        """
+        Returns the nested json of the events. The tree is built incrementally, only the events appended since the
+        last call are processed.
+        """
+        if self._builder is None:
+            self._builder = _EventTreeBuilder(self)
+        return self._builder.update()
+
+    def release(self, end):
+        """
+        Drops the values of the events before end, they are not needed once the events are in the tree.
+        """
+        for i in range(self.released, end):
+            self.chunks[i >> self.CHUNK_BITS][3][i & (self.CHUNK_SIZE - 1)] = None
+        self.released = max(self.released, end)
+
+
+class _EventTreeBuilder(object):
+    # rebuilds the nested json of FastPrint from an EventLog, it keeps the calls in progress between updates
+    def __init__(self, log):
+        self.log = log
+        self.json = OrderedDict({"print": OrderedDict(), "calls": OrderedDict()})
+        self.position = 0
+        self.counter = 0
+        self.open = {} # enter event id: (container, key, node, children container, kind), containers are _IndexNodes
+        self.journal = None # (container, key) of the added records when tracked for FastPrint.flush
+        root = _IndexNode(None, None, self.json, 0, None)
+        self.top = {EventLog.TOP_PRINT: _IndexNode(root, 'print', self.json['print'], 1, 'print'),
+                    EventLog.TOP_CALLS: _IndexNode(root, 'calls', self.json['calls'], 1, 'calls')}
+
+    def _container(self, parent):
+        if parent < 0:
+            return self.top[parent]
+        entry = self.open.get(parent)
+        return None if entry is None else entry[3]
+
+    def update(self):
+        log = self.log
+        names = log.names
+        for i, kind, parent, name, value in log.iter_events(self.position):
+            self.position = i + 1
+            base = kind & EventLog.KIND_MASK
+            if base == EventLog.EXIT:
+                entry = self.open.pop(parent, None)
+                if entry is None:
+                    continue
+                container, key, node, _, _ = entry
+                enter_kind = log.kind(parent)
+                if enter_kind & EventLog.DROPPED:
+                    container.value.pop(key, None)
+                    continue
+                calltime = None
+                if enter_kind & EventLog.TIMED:
+                    value, calltime = value
+                if entry[4] & EventLog.RETVAL and value is not EventLog.NO_VALUE:
+                    node.value['retval'] = value
+                    if self.journal is not None:
+                        self.journal.append((node, 'retval'))
+                if calltime is not None:
+                    node.value['time'] = calltime
+                    if self.journal is not None:
+                        self.journal.append((node, 'time'))
+                continue
+
+            container = self._container(parent)
+            key = str(self.counter).zfill(3) + '_' + names[name]
+            self.counter += 1
+            if container is None: # inside of a call that was dropped
+                continue
+            if self.journal is not None:
+                self.journal.append((container, key))
+            if base == EventLog.PRINT:
+                container.value[key] = value
+                continue
+            node = children = container.value[key] = OrderedDict()
+            if kind & EventLog.ARGS:
+                if isinstance(value, tuple): # arguments are bound now
+                    binder, wargs, wkwargs = value
+                    value = binder(wargs, wkwargs if wkwargs is not None else {})
+                    if kind & EventLog.LAZY:
+                        for k, v in value.items():
+                            value[k] = LazyValue(v)
+                node['args'] = value
+            if kind & EventLog.CALLS:
+                children = node['calls'] = OrderedDict()
+            node = _IndexNode(container, key, node, container.depth + 1, container.first)
+            children = node if children is node.value else _IndexNode(node, 'calls', children, node.depth + 1, node.first)
+            self.open[i] = (container, key, node, children, kind)
+        return self.json
+
+
+class SamplingPolicy(object):
+    """
+    Decides which calls of decorated functions are recorded. A call is recorded when it is one of the first calls, an
+    every-th call and fits into the rate (per second). Calls that are not sampled are only counted, with their subtrees.
+    Calls faster than slower_than seconds are recorded tentatively and dropped when they return. The state is kept in
+    the policy, functions that share a policy share the counts. The global policy of the config samples only the
+    top-level calls and the whole subtree of a sampled call is recorded, a policy of ff.sampled samples every call of
+    its functions.
+    """
+    def __init__(self, every=1, first=0, rate=0.0, slower_than=0.0):
+        self.every = max(int(every), 1)
+        self.first = int(first) # 0 for all
+        self.rate = float(rate) # 0 for unlimited
+        self.slower_than = float(slower_than) # seconds, 0 for all
+        self.skipped = 0
+        self._calls = itertools.count() # next() is atomic
+        self._window = None # start of the current one second window of the rate limit
+        self._window_count = 0
+
+    def samples_all(self):
+        return self.every == 1 and self.first <= 0 and self.rate <= 0 and self.slower_than <= 0
+
+    def sample(self):
+        n = next(self._calls)
+        if (self.first > 0 and n >= self.first) or (self.every > 1 and n % self.every != 0):
+            self.skipped += 1
+            return False
+        if self.rate > 0:
+            now = _clock()
+            if self._window is None or now - self._window >= 1.0:
+                self._window = now
+                self._window_count = 0
+            if self._window_count >= self.rate:
+                self.skipped += 1
+                return False
+            self._window_count += 1
+        return True
+
+
+class _Call(object):
+    # entry token of a call that is timed, profiled or stored in the event log, the plan alone is the token otherwise
+    __slots__ = ('plan', 'start', 'event', 'frame')
+
+    def __init__(self, plan, start, event, frame=None):
+        self.plan = plan
+        self.start = start # None when not timed
+        self.event = event # id of the enter event, None in the tree backend
+        self.frame = frame # _ProfileFrame when profiled
+
+
+class _Unit(object):
+    # records that are evicted together: a top-level call or print, or a finished call or a print nested in a top-level
+    # call in progress
+    __slots__ = ('container', 'key', 'records', 'nbytes', 'calls', 'parent', 'root', 'nested', 'evicted')
+
+    def __init__(self, container, key, parent=None):
+        self.container = container
+        self.key = key
+        self.records = 0 # records of the unit, including the finished nested units
+        self.nbytes = 0
+        self.calls = 0 # calls in progress, the unit is not evicted while there are any
+        self.parent = parent # unit of the enclosing call, None for the top-level units
+        self.root = self if parent is None else parent.root
+        self.nested = deque() if parent is None else None # finished nested units of the root, oldest first
+        self.evicted = False
+
+    def detached(self):
+        # evicted together with an enclosing unit
+        unit = self
+        while unit is not None:
+            if unit.evicted:
+                return True
+            unit = unit.parent
+        return False
+
+
+class CallTime(object):
+    """
+    Timing of a single call in nanoseconds, recorded as "time" of the call when profiling.
+    """
+    __slots__ = ('start', 'wall', 'cpu')
+
+    def __init__(self, start, wall, cpu):
+        self.start = start # perf counter at the start of the call
+        self.wall = wall
+        self.cpu = cpu
+
+    def __str__(self):
+        return '{} wall, {} cpu'.format(format_ns(self.wall), format_ns(self.cpu))
+
+
+def format_ns(ns):
+    for unit, scale in (('s', 1e9), ('ms', 1e6), ('us', 1e3)):
+        if ns >= scale:
+            return '{:.3g} {}'.format(ns / scale, unit)
+    return '{} ns'.format(ns)
+
+
+class ValueStats(object):
+    """
+    Aggregate of the values of a folded record (return values or prints), min, max and mean of the numbers and a sample
+    of distinct formatted values of the rest.
+    """
+    __slots__ = ('count', 'numbers', 'min', 'max', 'total', 'samples', 'nsamples', 'format')
+
+    def __init__(self, nsamples=3, format=str):
+        self.count = 0
+        self.numbers = 0
+        self.min = self.max = None
+        self.total = 0
+        self.samples = []
+        self.nsamples = nsamples
+        self.format = format
+
+    def add(self, value):
+        self.count += 1
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            self.numbers += 1
+            self.total += value
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+        elif len(self.samples) < self.nsamples: # the values are formatted only until the sample is full
+            s = self.format(value)
+            if s not in self.samples:
+                self.samples.append(s)
+
+    def __str__(self):
+        if self.count == 1 and (self.numbers or self.samples): # a single value is printed as it is
+            return str(self.min) if self.numbers else self.samples[0]
+        parts = []
+        if self.numbers:
+            parts.append('min {}, max {}, mean {:.6g}'.format(self.min, self.max, self.total / float(self.numbers)))
+        if self.count > self.numbers: # the sample is empty when nsamples is 0
+            more = self.count - self.numbers > len(self.samples) and len(self.samples) >= self.nsamples
+            parts.append(' | '.join(self.samples + ['...'] if more else self.samples))
+        return '{} values, {}'.format(self.count, '; '.join(parts))
+
+
+class FunctionStats(object):
+    """
+    Aggregated timing of all profiled calls of a function, in nanoseconds. Self time excludes the time spent in
+    traced calls made by the function. Recursive calls are included in the total time of each level.
+    """
+    __slots__ = ('name', 'count', 'total', 'self_total', 'max', 'cpu', 'self_cpu')
+    COLUMNS = ('count', 'total', 'self_total', 'max', 'cpu', 'self_cpu')
+
+    def __init__(self, name):
+        self.name = name
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0
+        self.self_total = 0
+        self.max = 0
+        self.cpu = 0
+        self.self_cpu = 0
+
+    def as_dict(self):
+        d = OrderedDict([('name', self.name)])
+        for column in self.COLUMNS:
+            d[column] = getattr(self, column)
+        return d
+
+
+class _ProfileFrame(object):
+    # profiled call in progress, the children add their time to it
+    __slots__ = ('parent', 'stats', 'start', 'start_cpu', 'child_wall', 'child_cpu')
+
+    def __init__(self, parent, stats, start, start_cpu):
+        self.parent = parent
+        self.stats = stats
+        self.start = start
+        self.start_cpu = start_cpu
+        self.child_wall = 0
+        self.child_cpu = 0
+
+
+class Profiler(object):
+    """
+    Measures wall and cpu time of the calls of decorated functions and aggregates them per function. Every thread
+    and asyncio task has its own stack of calls in progress. The cpu time is the time of the thread where available.
+    """
+    def __init__(self):
+        self.stats = OrderedDict() # function key: FunctionStats
+        self._frame = ContextVar('profile_frame', default=None)
+        self._lock = threading.Lock() # guards the FunctionStats and the child times, the calls of threads add to them
+
+    def function_stats(self, func):
+        key = getattr(func, '__module__', None), getattr(func, '__qualname__', func.__name__)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats.setdefault(key, FunctionStats(key[1]))
+        return stats
+
+    def reset(self):
+        with self._lock:
+            for stats in self.stats.values():
+                stats.reset()
+
+    def enter(self, stats):
+        frame = _ProfileFrame(self._frame.get(), stats, _clock_ns(), _cpu_clock_ns())
+        self._frame.set(frame)
+        return frame
+
+    def exit(self, frame):
+        wall = _clock_ns() - frame.start
+        cpu = _cpu_clock_ns() - frame.start_cpu
+        parent = frame.parent
+        self._frame.set(parent)
+        stats = frame.stats
+        with self._lock:
+            stats.count += 1
+            stats.total += wall
+            stats.self_total += max(wall - frame.child_wall, 0) # concurrent child tasks can take longer than the parent
+            stats.cpu += cpu
+            stats.self_cpu += max(cpu - frame.child_cpu, 0)
+            if wall > stats.max:
+                stats.max = wall
+            if parent is not None:
+                parent.child_wall += wall
+                parent.child_cpu += cpu
+        return CallTime(frame.start, wall, cpu)
+
+    def sorted_stats(self, sort='total'):
+        if sort != 'name' and sort not in FunctionStats.COLUMNS:
+            raise ValueError('sort has to be name or one of {}, got "{}"'.format(FunctionStats.COLUMNS, sort))
+        stats = [s for s in self.stats.values() if s.count > 0]
+        return sorted(stats, key=lambda s: getattr(s, sort), reverse=sort != 'name')
+
+    def report(self, sort='total', limit=None):
+        """
+        Returns table of the function stats sorted by the sort column.
+        """
+        stats = self.sorted_stats(sort)
+        if limit is not None:
+            stats = stats[:limit]
+        name_len = max([len('function')] + [len(s.name) for s in stats])
+        row_format = '{{:<{}}}'.format(name_len + 2) + '{:>10}' + '{:>12}' * 6
+        lines = [row_format.format('function', 'calls', 'total', 'self', 'max', 'per call', 'cpu', 'self cpu')]
+        for s in stats:
+            lines.append(row_format.format(s.name, s.count, format_ns(s.total), format_ns(s.self_total),
+                                           format_ns(s.max), format_ns(s.total // s.count), format_ns(s.cpu),
+                                           format_ns(s.self_cpu)))
+        return '\n'.join(lines)
+
+
+_MUTED = object() # entry token of a call that is not stored together with its subtree
+
+
+def _binding(func):
+    # module or class that binds the function by its qualified name and the name, (None, None) for the functions
+    # defined inside of other functions, the binding itself is looked up when the tracing is switched
+    qualname = getattr(func, '__qualname__', func.__name__)
+    if '<locals>' in qualname or '<lambda>' in qualname:
+        return None, None
+    owner = sys.modules.get(func.__module__)
+    path = qualname.split('.')
+    for name in path[:-1]:
+        owner = getattr(owner, name, None)
+    if owner is None or not hasattr(owner, '__dict__'):
+        return None, path[-1]
+    return owner, path[-1]
+
+
+class FastPrintFlags(object):
+    """
+    Immutable snapshot of the FastPrint config. Reading a flag is a plain attribute access, which is what the function
+    wrappers do on every call. FastPrint.config creates a new snapshot with increased version.
+    """
+    __slots__ = ('version', 'use_function_wrappers', 'print_fn_args', 'print_fn_retval', 'max_depth', 'simple',
+                 'capped_func_names', 'capture', 'max_value_chars', 'max_value_items', 'max_value_ms', 'max_records',
+                 'max_bytes',
+                 'spill_path', 'bounded', 'sampling', 'backend', 'profile', 'fold', 'fold_samples', 'shard_dir')
+    CAPTURE_MODES = ('str', 'ref', 'copy')
+    BACKENDS = ('tree', 'events')
+
+    def __init__(self, configfile, version):
+        self.version = version
+        self.use_function_wrappers = configfile.get_bool('use_function_wrappers')
+        self.print_fn_args = configfile.get_bool('print_fn_args')
+        self.print_fn_retval = configfile.get_bool('print_fn_retval')
+        self.max_depth = configfile.get_int('max_depth')
+        self.simple = configfile.get_bool('simple')
+        self.capped_func_names = configfile.get_bool('capped_func_names')
+        self.capture = configfile.get_string('capture').strip()
+        if self.capture not in self.CAPTURE_MODES:
+            raise ValueError('capture has to be one of {}, got "{}"'.format(self.CAPTURE_MODES, self.capture))
+        self.max_value_chars = configfile.get_int('max_value_chars')
+        self.max_value_items = configfile.get_int('max_value_items')
+        self.max_value_ms = configfile.get_float('max_value_ms')
+        self.max_records = configfile.get_int('max_records')
+        self.max_bytes = configfile.get_int('max_bytes')
+        self.spill_path = configfile.get_string('spill_path').strip()
+        self.bounded = self.max_records > 0 or self.max_bytes > 0
+        sampling = SamplingPolicy(every=configfile.get_int('sample_every'), first=configfile.get_int('sample_first'),
+                                  rate=configfile.get_float('sample_rate'),
+                                  slower_than=configfile.get_float('sample_slower_than'))
+        self.sampling = None if sampling.samples_all() else sampling # global policy, applied to the top-level calls
+        self.profile = configfile.get_bool('profile')
+        self.fold = configfile.get_bool('fold')
+        self.fold_samples = configfile.get_int('fold_samples')
+        self.shard_dir = configfile.get_string('shard_dir').strip()
+        self.backend = configfile.get_string('backend').strip()
+        if self.backend not in self.BACKENDS:
+            raise ValueError('backend has to be one of {}, got "{}"'.format(self.BACKENDS, self.backend))
+        if self.backend == 'events' and self.bounded and not self.fold: # the event log is append-only
+            raise ValueError('max_records and max_bytes apply only to the tree backend, set them to 0 or use backend=tree')
+
+
 class FastPrint(object):
+    # methods of decorated classes that are not traced, python and the tracing itself calls them implicitly
+    UNTRACED_METHODS = frozenset(['__new__', '__init_subclass__', '__class_getitem__', '__subclasshook__', '__del__',
+                                  '__getattribute__', '__getattr__', '__setattr__', '__delattr__', '__repr__', '__str__',
+                                  '__format__', '__hash__', '__sizeof__', '__dir__', '__reduce__', '__reduce_ex__',
+                                  '__getstate__', '__setstate__', '__copy__', '__deepcopy__', '__dict__', '__weakref__',
+                                  '__module__', '__qualname__', '__doc__', '__slots__'])
+
+    # environment variable that overrides use_function_wrappers, e.g. EZPRINT_TRACING=0 turns the tracing off
+    TRACING_ENV = 'EZPRINT_TRACING'
+    # shard_dir and the pid of the parent process, set for the worker processes by the process that writes shards
+    SHARD_DIR_ENV = 'EZPRINT_SHARD_DIR'
+    SHARD_PARENT_ENV = 'EZPRINT_SHARD_PARENT'
+
     def __init__(self, configpath='.fastprint_config.txt'):
-        self.configfile = self._get_config(configpath)
-        self.clear()
+        # the config is loaded (or created) and the trace set up on the first use, see __getattr__, so creating the
+        # instance touches no files
+        self._configpath = configpath
+        self._loading = None # ident of the thread that is loading the config
+        self._load_lock = threading.RLock()
+        parent = os.environ.get(self.SHARD_PARENT_ENV, '')
+        self._shard_parent = (int(parent), None) if parent.isdigit() else None # (pid, index path of the call)
+        self._shard_pid = None # pid of the process the shard is written for
+        self._shard_started = time.time()
+        self._switchable = {} # function -> wrapper, for the functions that can be rebound by the switch
+        self._swapped = set() # functions whose binding the switch replaced by the original, rebound when enabled
+        self._switchable_classes = weakref.WeakKeyDictionary() # wrapped class -> its wrapped methods
+        self._names = [] # interned names of the event log
+        self._name_ids = {}
+        self.profiler = Profiler()
+        self._formatter = None
+        self.printer = JsonPrinter(formatter=self._format_value)
+
+    def __getattr__(self, name):
+        # called only for the attributes that don't exist yet, i.e. before the config is loaded
+        # only the loading thread gets the error for the attributes _load didn't set yet, the others wait for the load
+        if name.startswith('__') or '_load_lock' not in self.__dict__ or 'configfile' in self.__dict__ or \
+                self._loading == threading.get_ident():
+            raise AttributeError(name)
+        with self._load_lock:
+            if 'configfile' not in self.__dict__:
+                self._load()
+        return object.__getattribute__(self, name)
+
+    def _load(self):
+        self._loading = threading.get_ident()
+        try:
+            configfile = self._get_config(self._configpath)
+            if os.environ.get(self.TRACING_ENV, '') != '':
+                try:
+                    configfile.set_value('use_function_wrappers', parse_bool(os.environ[self.TRACING_ENV]))
+                except ValueError: # the traced application must not fail on the value
+                    print('WARNING: ignoring {}={}, expected 1/0 or true/false.'.format(self.TRACING_ENV,
+                                                                                    os.environ[self.TRACING_ENV]))
+            if os.environ.get(self.SHARD_DIR_ENV, '') != '':
+                configfile.set_value('shard_dir', os.environ[self.SHARD_DIR_ENV])
+            self.flags = None
+            self._events = None
+            self.configfile = configfile
+            self._compile_flags()
+            self.clear()
+        finally:
+            self._loading = None
 
     def clear(self):
-        self.json = OrderedDict({"print": OrderedDict(), "calls": OrderedDict()})
-        self.index = JsonIndex(self.json)
-        self.counter = 0
+        self._json = OrderedDict({"print": OrderedDict(), "calls": OrderedDict()})
+        self.index = JsonIndex(self._json) # every thread and asyncio task has its own position
+        self._events = EventLog(self._names) if self.flags.backend == 'events' and not self.flags.fold else None
+        self.profiler.reset()
+        self._counter = itertools.count() # next() is atomic, keys stay unique across threads
+        self._depth = ContextVar('call_depth', default=0) # calls in progress, including the ones deeper than max_depth
+        self._mute = ContextVar('mute', default=0) # depth of the call that is not stored with its subtree, 0 if none
+        self.dropped_calls = 0 # calls deeper than max_depth or inside of unsampled calls, counted but not stored
+        self.unsampled_calls = 0 # calls skipped by a SamplingPolicy
+        self.dropped_records = 0 # prints inside of the dropped calls
+        self.evicted_records = 0
+        self.nrecords = 0 # stored records, counted only when max_records or max_bytes is set
+        self.nbytes = 0
+        self._units = deque() # top-level _Units in order of creation
+        self._unit = ContextVar('unit', default=None) # the unit that records are added to, of the innermost call
+        self._lock = threading.Lock() # guards the record accounting and eviction
+        self._journal = None # (index position, key) of the records added since the last flush, None before the first
+        self._folds = {} # (id of container, name) -> key of the folded record
+        self._fold_units = {} # key of a top-level folded record -> its unit of eviction
+
+    @property
+    def call_depth(self):
+        return self._depth.get()
+
+    @property
+    def json(self):
+        if self._events is not None: # rebuilt from the event log
+            return self._events.tree()
+        return self._json
+
+    def _intern(self, name):
+        i = self._name_ids.get(name)
+        if i is None:
+            with self._lock:
+                i = self._name_ids.setdefault(name, len(self._names))
+                if i == len(self._names):
+                    self._names.append(name)
+        return i
+
+    def flush(self, out=None, release=False):
+        """
+        Prints only the records added since the previous flush (everything on the first one), nested in their calls
+        and indented as in the whole json, so periodic dumps of long runs cost as much as the new activity. With release
+        the flushed records are dropped from memory, calls in progress keep recording.
+        """
+        out = sys.stdout if out is None else out
+        if self._events is not None:
+            json = self._events.tree()
+            builder = self._events._builder
+            journal = builder.journal
+            if journal is None: # the records are tracked from now on
+                builder.journal = deque()
+        else:
+            json = self._json
+            journal = self._journal
+            if journal is None:
+                self._journal = deque()
+        view = json if journal is None else self._flush_view(journal)
+        if len(view) > 0: # the released records are printed only here, nothing is collapsed
+            self._full_printer().jprint(view, out)
+        if release:
+            self._release(json)
+
+    def _full_printer(self):
+        # printer of the outputs that must not lose records, the layout of self.printer without collapsing
+        printer = self.printer
+        return JsonPrinter(printer.ncols, printer.nindents, None, None, printer.formatter)
+
+    def _flush_view(self, journal):
+        # json of the journaled records with their ancestors, the records are taken whole, so the journaled records
+        # inside of them are skipped
+        view = _FlushView()
+        for _ in range(len(journal)): # records can be journaled by other threads meanwhile
+            node, key = journal.popleft()
+            container = node.value
+            path = []
+            while node.parent is not None:
+                path.append(node.key)
+                node = node.parent
+            target = view
+            for k in reversed(path):
+                child = target.get(k)
+                if child is None:
+                    child = target[k] = _FlushView()
+                elif not isinstance(child, _FlushView): # inside of a flushed record
+                    break
+                target = child
+            else:
+                try:
+                    target[key] = container[key]
+                except (KeyError, IndexError): # dropped since
+                    pass
+        return view
+
+    def _release(self, json):
+        for section in json.values(): # the calls in progress stay referenced by the index positions
+            section.clear()
+        self._folds = {}
+        self._fold_units = {}
+        if self._events is not None:
+            self._events.release(self._events._builder.position)
+        elif self.flags.bounded:
+            with self._lock:
+                self._units = deque(unit for unit in self._units if unit.calls > 0)
+                self.nrecords = sum(unit.records for unit in self._units)
+                self.nbytes = sum(unit.nbytes for unit in self._units)
 
     def hline(self, ncols=80, nrows=1):
         for _ in range(nrows):
@@ -117,138 +1214,422 @@ class FastPrint(object):
             if not self.configfile.contains(key):
                 raise ValueError('key {} is not present in config fields'.format(key))
             self.configfile.set_value(key, val)
+        self._compile_flags()
+
+    def enable(self):
+        """
+        Turns the tracing on, the decorated functions and classes are traced again.
+        """
+        self.config(use_function_wrappers=True)
+
+    def disable(self):
+        """
+        Turns the tracing off at runtime, the decorated functions bound by their names in modules and classes are
+        swapped back to the originals and the wrapped classes lose their wrapped methods, so they cost nothing. Other
+        references to the wrappers (e.g. imported before the switch) only pass the call through.
+        """
+        self.config(use_function_wrappers=False)
+
+    def sampled(self, every=1, first=0, rate=0.0, slower_than=0.0, **kwargs):
+        """
+        Decorator that traces the function (or class) with its own SamplingPolicy instead of the global one, e.g.
+        @ff.sampled(every=100). The policy applies to all calls of the function, nested ones too. Other keyword arguments are passed to the decorator as in ff(func, **kwargs).
+        """
+        policy = SamplingPolicy(every, first, rate, slower_than)
+        def decorator(func):
+            return self(func, sampling=policy, **kwargs)
+        return decorator
+
+    def stats(self, sort='total'):
+        """
+        Returns the profiled FunctionStats sorted by sort (name, count, total, self_total, max, cpu, self_cpu), times
+        are in nanoseconds. Calls are profiled when the config field profile is set.
+        """
+        return self.profiler.sorted_stats(sort)
+
+    def print_stats(self, sort='total', limit=None, out=None):
+        out = sys.stdout if out is None else out
+        out.write(self.profiler.report(sort, limit) + '\n')
+
+    def _compile_flags(self):
+        # wrappers read the flags snapshot instead of the config file, the version tells them to recompile
+        previous = self.flags
+        self.flags = FastPrintFlags(self.configfile, 0 if previous is None else previous.version + 1)
+        if previous is not None and (previous.backend != self.flags.backend or previous.fold != self.flags.fold):
+            self.clear()
+        # the functions decorated before the config was loaded are wrapped
+        if self.__dict__.get('tracing', True) != self.flags.use_function_wrappers:
+            self._switch(self.flags.use_function_wrappers)
+        self.tracing = self.flags.use_function_wrappers
+        if self.flags.shard_dir and self._shard_pid != os.getpid():
+            self._start_sharding()
+
+    def _start_sharding(self):
+        # the shard is written at exit, also by the processes of multiprocessing which skip the atexit handlers
+        first = self._shard_pid is None
+        self._shard_pid = os.getpid()
+        os.environ[self.SHARD_DIR_ENV] = os.path.abspath(self.flags.shard_dir) # for the spawned worker processes
+        os.environ[self.SHARD_PARENT_ENV] = str(self._shard_pid)
+        atexit.register(self._write_shard_at_exit)
+        util = sys.modules.get('multiprocessing.util')
+        if util is not None: # the workers clear the finalizers when they start and then run the after fork callbacks
+            self._finalize_shard()
+            util.register_after_fork(self, FastPrint._finalize_shard)
+        if first and hasattr(os, 'register_at_fork'): # python >= 3.7
+            os.register_at_fork(after_in_child=self._forked)
+
+    def _finalize_shard(self):
+        sys.modules['multiprocessing.util'].Finalize(None, self._write_shard_at_exit, exitpriority=0)
+
+    def _forked(self):
+        # the child continues with an empty trace at the position of the forking call, the path is its context
+        if self._shard_pid is None or not self.flags.shard_dir:
+            return
+        path = self.index.indices if self._events is None else None
+        depth, mute = self._depth.get(), self._mute.get()
+        self.clear()
+        if path:
+            container = self._json
+            for key in path:
+                container = container.setdefault(key, OrderedDict())
+            self.index.reset(path[0])
+            for key in path[1:]:
+                self.index.deeper(key)
+        self._depth.set(depth)
+        self._mute.set(mute)
+        self._shard_parent = (self._shard_pid, path)
+        self._shard_started = time.time()
+        self._start_sharding()
+
+    def write_shard(self, directory=None):
+        """
+        Writes the trace of this process into directory (shard_dir by default) as a shard tagged with the pid and the
+        call of the parent process it was started from, returns the path. Processes write their shards at exit when
+        shard_dir is set, see ezprint_shard.
+        """
+        from ezprint_shard import write_shard
+        directory = directory or self.flags.shard_dir
+        if not directory:
+            raise ValueError('no directory given and shard_dir is not set')
+        return write_shard(self.json, directory, self._shard_parent, self._format_value, self._shard_started)
+
+    def _write_shard_at_exit(self):
+        if self._shard_pid != os.getpid() or not self.flags.shard_dir: # registered by the parent process
+            return
+        try:
+            self.write_shard()
+        except Exception as e:
+            sys.stderr.write('ezprint: could not write the trace shard: {}\n'.format(e))
+
+    def _switch(self, tracing):
+        # rebinds the names of the decorated functions, wrappers kept elsewhere check self.tracing on every call
+        for func, wrapper in list(self._switchable.items()):
+            if tracing and func not in self._swapped: # e.g. traced = ff(func), the name keeps the original
+                continue
+            owner, name = _binding(func)
+            current, replacement = (func, wrapper) if tracing else (wrapper, func)
+            if owner is not None and vars(owner).get(name) is current:
+                setattr(owner, name, replacement)
+                if tracing:
+                    self._swapped.discard(func)
+                else:
+                    self._swapped.add(func)
+            elif tracing:
+                self._swapped.discard(func) # rebound by the caller meanwhile
+        for cls, methods in list(self._switchable_classes.items()):
+            for name, method in methods.items():
+                if tracing:
+                    setattr(cls, name, method)
+                elif vars(cls).get(name) is method: # the methods of the decorated class are inherited again
+                    delattr(cls, name)
 
     def _get_config(self, path):
         # method that searches the pwd for
         import os
+        config = self._default_config()
         if os.path.exists(path):
-            return ConfigFile(path)
+            config.load(path, overwrite=True) # fields missing in the file (e.g. from older versions) keep defaults
         else: # default config
-            print('Creating new config file with default settings, .fastprint_config.txt')
-            config = ConfigFile()
-            ### TO DO: defaults,
-            # config.add_bool('use_class_wrappers', True, comment='set false when you want to deactivate all class wrappers')
-            config.add_bool('use_function_wrappers', True, comment='set false when you want to deactivate all function '
-                                                                   'wrappers (including the ones from class wrappers)')
-            config.add_bool('print_fn_args', True, comment='set false when you don\'t want to print arguments for each function call')
-            config.add_bool('print_fn_retval', True, comment='set false when you don\' want to print returned value for each fn call')
-            config.add_int('max_depth', 10, comment='Set the maximum print depth')
-            config.add_bool('simple', False, comment='Set true when you want simple function print omitting args and retvals')
-            config.add_bool('capped_func_names', True, comment='Set true to capitalize all function names for easier readability')
-            config.save(path)
-            return config
+            # parallel processes may create it at the same time, the file is replaced whole
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                config.save(tmp)
+                getattr(os, 'replace', os.rename)(tmp, path)
+            except (IOError, OSError): # read-only filesystem, the defaults are used
+                pass
+            else:
+                print('Creating new config file with default settings, .fastprint_config.txt')
+        return config
+
+    def _default_config(self):
+        config = ConfigFile()
+        ### TO DO: defaults,
+        # config.add_bool('use_class_wrappers', True, comment='set false when you want to deactivate all class wrappers')
+        config.add_bool('use_function_wrappers', True, comment='set false when you want to deactivate all function '
+                                                               'wrappers (including the ones from class wrappers)')
+        config.add_bool('print_fn_args', True, comment='set false when you don\'t want to print arguments for each function call')
+        config.add_bool('print_fn_retval', True, comment='set false when you don\' want to print returned value for each fn call')
+        config.add_int('max_depth', 10, comment='Set the maximum print depth')
+        config.add_bool('simple', False, comment='Set true when you want simple function print omitting args and retvals')
+        config.add_bool('capped_func_names', True, comment='Set true to capitalize all function names for easier readability')
+        config.add_string('capture', 'str', comment='How values are captured: str (formatted at call time), ref (reference '
+                                                    'formatted when printed), copy (shallow copy formatted when printed)')
+        config.add_int('max_value_chars', 200, comment='Max characters of a value captured with ref or copy when printed and of the summaries')
+        config.add_int('max_value_items', 20, comment='Max container items of a value captured with ref or copy when printed')
+        config.add_float('max_value_ms', 10.0, comment='Time budget of the summary of a large value (numpy array, sequence, '
+                                                       'mapping), see ValueFormatter.register')
+        config.add_int('max_records', 0, comment='Max number of stored records, oldest finished calls and prints are '
+                                                 'evicted when exceeded. 0 for unlimited')
+        config.add_int('max_bytes', 0, comment='Max approximate size of stored records in bytes, oldest finished calls '
+                                               'and prints are evicted when exceeded. 0 for unlimited')
+        config.add_string('spill_path', '', comment='File that evicted calls and prints are appended to, empty to discard them')
+        config.add_int('sample_every', 1, comment='Record only every n-th top-level call of decorated functions')
+        config.add_int('sample_first', 0, comment='Record only the first n top-level calls of decorated functions, 0 for all')
+        config.add_float('sample_rate', 0.0, comment='Record at most n top-level calls of decorated functions per second, 0 for unlimited')
+        config.add_float('sample_slower_than', 0.0, comment='Record only top-level calls that take at least n seconds, 0 for all')
+        config.add_bool('profile', False, comment='Set true to measure wall and cpu time of each call, see ff.stats()')
+        config.add_string('backend', 'tree', comment='Storage of the trace: tree (nested json) or events (compact event log, '
+                                                    'the json is rebuilt when printed, not bounded by max_records and '
+                                                    'max_bytes). Changing it clears the trace')
+        config.add_bool('fold', False, comment='Set true to merge sibling calls of the same function (and prints of the same '
+                                               'name) into one record with counts. Stored in the tree, changing it clears the trace')
+        config.add_int('fold_samples', 3, comment='Number of distinct arguments and values kept by the folded records')
+        config.add_string('shard_dir', '', comment='Directory where every traced process writes its trace at exit, the worker '
+                                                   'processes inherit it. Merge with python ezprint_shard.py DIR')
+        return config
 
     # def
     def _next_counter(self):
-        self.counter += 1
-        return str(self.counter-1).zfill(3)
+        return str(next(self._counter)).zfill(3)
 
     def __str__(self):
-        jp = JsonPrinter()
-        return jp.jstr(self.json)
+        return self.printer.jstr(self.json)
         # pp = pprint.PrettyPrinter(indent=4, width=80)
         # pp.pprint(self.json)
 
-    def _construct_args_dict(self, argspec, fargs, fkwargs):
-        # arguments consistency does not need to be checked
-        # because python raises exception on calls with invalid
-        # arguments implicitly
-        args, varargs, varkw, defaults = argspec[:4]
-        if args[0] == 'self':
-            args = args[1:]
-        defaults = defaults if defaults is not None else []
-        di = len(args) - len(defaults)
-
-        # initialize dict with argument names and values (default if not provided)
-        d = {key:fargs[i] if i < len(fargs) else # unnamed function arguments
-                 fkwargs[key] if (key in fkwargs.keys()) else # keyword arguments
-                 defaults[i - di] if i >= di else# default values otherwise
-                 'ParameterNotDefined-Error, please report'
-                 for i,key in enumerate(args)}
-
-        # fill in *args
-        if varargs is not None:
-            d[varargs] = list(fargs[len(fargs)-len(args):]) if len(fargs)-len(args) > 0 else []
-
-        # fill in **kwargs
-        if varkw is not None:
-            d[varkw] = {key:val for key,val in fkwargs.items() if key not in args}
-
-        return d
-
+    def write(self, out):
+        """
+        Streams the contents into the file-like object out (stdout, file, socket...), without building the string.
+        Nothing is collapsed, unlike in the interactive ff() and str(ff).
+        """
+        self._full_printer().write(self.json, out)
+
+    def write_collapsed(self, out):
+        """
+        Streams the call tree into out as collapsed stacks for flame graphs, see ezprint_export.write_collapsed.
+        """
+        from ezprint_export import write_collapsed
+        write_collapsed(self.json, out)
+
+    def write_chrome_trace(self, out):
+        """
+        Streams the call tree into out as Chrome trace-event json, see ezprint_export.write_chrome_trace.
+        """
+        from ezprint_export import write_chrome_trace
+        write_chrome_trace(self.json, out, formatter=self._format_value)
 
     def __call__(self, *args, **kwargs):
         if len(args) == len(kwargs) == 0: # p() ... print contents of fast print object
-            print(self.__str__())
+            self.printer.jprint(self.json)
         elif len(args) >= 1 and (callable(args[0]) or isinstance(args[0], type)): # decorator case
-            def decorate(func, instance=None):
-                def wrapper(*wargs, **wkwargs):  # function wrapper that replaces the decorated function
-                    def entry(*args, **kwargs):
-                        self.jump_to_call() # make sure the correct index is in place
-
-                        import sys
-                        if sys.version_info >= (3,0):
-                            # inspection for argument names and default values
-                            argspec = inspect.getfullargspec(func)  # Works only for python 2.x
+            def decorate(func, skip_first=None):
+                binder = ArgBinder(func, skip_first) # inspection for argument names and default values happens only once
+                # decorator arguments, e.g. ff(func, print_fn_args=False)
+                allow_args = kwargs.get('print_fn_args', True)
+                allow_retval = kwargs.get('print_fn_retval', True)
+                sampling = kwargs.get('sampling', None) # SamplingPolicy of the function, the global one otherwise
+                plan_cache = [None] # call plan compiled for a certain version of the flags
+
+                def compile_plan(flags):
+                    # (version, function name, record args, record calls and retval level, record retval, sampling,
+                    #  interned name, FunctionStats when profiled)
+                    name = func.__name__.upper() if flags.capped_func_names else func.__name__
+                    plan = (flags.version,
+                            name,
+                            not flags.simple and allow_args and flags.print_fn_args,
+                            not flags.simple,
+                            not flags.simple and allow_retval and flags.print_fn_retval,
+                            sampling if sampling is not None else flags.sampling,
+                            self._intern(name),
+                            self.profiler.function_stats(func) if flags.profile else None)
+                    plan_cache[0] = plan
+                    return plan
+
+                def entry(wargs, wkwargs):
+                    plan = plan_cache[0]
+                    if plan is None or plan[0] != self.flags.version: # config has changed since the last call
+                        plan = compile_plan(self.flags)
+                    if plan[7] is None:
+                        return begin(plan, wargs, wkwargs)
+                    # profiled, the time is measured after the call is recorded
+                    token = begin(plan, wargs, wkwargs)
+                    if type(token) is not _Call:
+                        token = _Call(token, None, None)
+                    token.frame = self.profiler.enter(plan[7])
+                    return token
+
+                def begin(plan, wargs, wkwargs):
+                    _, name, record_args, record_calls, record_retval, policy, name_id, _ = plan
+
+                    depth = self._depth.get() + 1
+                    self._depth.set(depth)
+                    if self._mute.get() > 0: # inside of a call that is not stored
+                        self.dropped_calls += 1
+                        return None
+                    if depth > self.flags.max_depth: # too deep, only count the call and mute its subtree
+                        self.dropped_calls += 1
+                        self._mute.set(depth)
+                        return _MUTED
+                    if policy is not None and sampling is None and depth > 1: # the global policy decides at the root
+                        policy = None
+                    if policy is not None and not policy.sample(): # skipped, only count the call and mute its subtree
+                        self.unsampled_calls += 1
+                        self._mute.set(depth)
+                        return _MUTED
+
+                    timed = policy is not None and policy.slower_than > 0 # decided when the call returns
+                    events = self._events
+                    if events is not None:
+                        kind = EventLog.ENTER
+                        value = None
+                        if record_args:
+                            kind |= EventLog.ARGS
+                            if self.flags.capture == 'copy': # the snapshot has to be taken now
+                                value = binder(wargs, wkwargs)
+                                for key, v in value.items():
+                                    value[key] = self._stringify(v)
+                            else: # arguments are bound when the json is rebuilt
+                                value = (binder, wargs, wkwargs if wkwargs else None) # empty dicts are not kept
+                                if self.flags.capture == 'ref':
+                                    kind |= EventLog.LAZY
+                        if record_calls:
+                            kind |= EventLog.CALLS
+                        if record_retval:
+                            kind |= EventLog.RETVAL
+                        return _Call(plan, _clock() if timed else None, events.enter(kind, name_id, value))
+
+                    self.jump_to_call() # make sure the correct index is in place
+                    if self.flags.fold: # sibling calls of the function share the record
+                        tentative = None
+                        if depth > 1 and timed and self.flags.bounded: # counted apart until it's known if it's dropped
+                            tentative = self._enter_unit(self.index.get_value(), None, False)
+                        key = self._enter_fold(name, binder(wargs, wkwargs) if record_args else None, record_calls)
+                        if tentative is not None:
+                            tentative.key = key
+                        elif depth == 1 and self.flags.bounded: # the unit of the folded record, possibly of another thread
+                            unit = self._fold_units.get(key)
+                            if unit is not None:
+                                self._unit.set(unit)
+                                self._hold(unit, 1)
+                        return _Call(plan, _clock(), None) if timed else plan
+                    ix = self._next_counter() + '_' + name
+                    if self.flags.bounded: # the records of the call go to its unit
+                        self._enter_unit(self.index.get_value(), ix, len(self.index) == 1)
+                    self.add_dict(ix, {})
+                    # go deeper into the fname level
+                    self.index.deeper(ix)
+                    # add dictionary with parameter names and values if not disallowed
+                    if record_args:
                         # put together the actual parameter-value pairs that the function receives
-                        else:
-                            argspec = inspect.getargspec(func)
-
-                        argsdict = self._construct_args_dict(argspec, wargs, wkwargs)
-                        fname = func.__name__.upper() if self.configfile.get_bool('capped_func_names') else func.__name__
-                        fname = self._next_counter() + '_' + fname
-                        ix = self.add_dict(fname, {})
-                        # go deeper into the fname level
+                        argsdict = binder(wargs, wkwargs)
+                        if self.flags.capture != 'str': # values are formatted when printed
+                            for key, value in argsdict.items():
+                                argsdict[key] = self._stringify(value)
+                        self.add_dict('args', argsdict)
+
+                    if record_calls:
+                        ix = self.add_dict('calls', {})
+                        # go deeper into the "calls" level
                         self.index.deeper(ix)
-                        # add dictionary with parameter names and values if not disallowed
-                        if not self.configfile.get_bool('simple') and\
-                            ('print_fn_args' not in kwargs or kwargs['print_fn_args']) and\
-                            self.configfile.get_bool('print_fn_args'):
-                            self.add_dict('args', argsdict)
-
-                        if not self.configfile.get_bool('simple'):
-                            ix = self.add_dict('calls', {})
-                            # go deeper into the "calls" level
-                            self.index.deeper(ix)
-
-                        # return argspec[0][0] if len(argspec[0]) > 0 else None
-
-
-                    def exit(*args, **kwargs):
-                        retval = [args[0]]
-                        args = args[1:]
-
-                        if not self.configfile.get_bool('simple'):
-                            # get out of the "calls" level
-                            self.index.higher()
-
-                        # add dictionary with retvals if not disallowed
-                        if  not self.configfile.get_bool('simple') and\
-                            ('print_fn_retval' not in kwargs or kwargs['print_fn_retval']) and \
-                            self.configfile.get_bool('print_fn_retval'):
-                            self.add_dict_record('retval', str(retval))
+                    if timed:
+                        return _Call(plan, _clock(), None)
+                    return plan
+
+                def exit(plan, retval, returned=True):
+                    # the plan from the entry is used, so that the index stays consistent even if config changes
+                    # during the call
+                    start = event = calltime = None
+                    if type(plan) is _Call:
+                        if plan.frame is not None: # the time is measured before the call is recorded
+                            calltime = self.profiler.exit(plan.frame)
+                        plan, start, event = plan.plan, plan.start, plan.event
+                    depth = self._depth.get() - 1
+                    self._depth.set(depth)
+                    if plan is None: # the call was not stored
+                        return
+                    if plan is _MUTED: # the call muted its subtree
+                        self._mute.set(0)
+                        return
+                    _, _, _, record_calls, record_retval, policy, _, _ = plan
+                    drop = start is not None and _clock() - start < policy.slower_than # too fast, the record is dropped
+                    if drop:
+                        self.unsampled_calls += 1
+
+                    if event is not None:
+                        value = EventLog.NO_VALUE
+                        if record_retval and returned:
+                            value = self._stringify([self._snapshot(retval)] if self.flags.capture == 'copy' else [retval])
+                        self._events.exit(event, value, drop, calltime)
+                        return
+                    if record_calls:
+                        # get out of the "calls" level
                         self.index.higher()
-                        if len(self.index) == 0:
-                            self.index.deeper('print') # return to regular print
-                        pass
-
-
 
-                    entry(*args, **kwargs)  # call wrappers with outer, decorator arguments
-
-                    # when we call a method of the wrapped class for the first time, the NewCls.__getattr__ is called,
-                    # however, the wrapped function by default receives self instance of the wrapped class, so any
-                    # calls that happen inside a wrapped class' methods don't get wrapped, because in order to get wrapped
-                    # the self instance that the wrapped class' method receives upon call has to be the NewCls class instance.
-                    # therefore, we call the method from the class object itself providing our own instance
-                    if instance is not None:
-                        retval = object.__getattribute__(func.__self__.__class__, func.__name__)(instance, *wargs, **wkwargs)
-                    else:
+                    fold = self.flags.fold
+                    # add dictionary with retvals if not disallowed
+                    if record_retval and returned:
+                        if fold:
+                            self._fold_value('retval', retval)
+                        else:
+                            self.add_dict_record('retval', [self._snapshot(retval)] if self.flags.capture == 'copy' else [retval])
+                    if calltime is not None and not fold: # the profiler aggregates the times of folded calls
+                        self.add_dict_record('time', calltime, stringify=False)
+                    key = self.index.higher()
+                    container = self.index.get_value()
+                    if drop:
+                        if fold and key in container and container[key]['count'] > 1:
+                            container[key]['count'] -= 1 # the other calls stay, the merged subtree can't be undone
+                        else:
+                            container.pop(key, None)
+                    unit = self._unit.get()
+                    if unit is not None:
+                        if fold:
+                            if depth == 0:
+                                self._hold(unit, -1)
+                                if drop and key not in container and unit.key == key: # the folded record is gone
+                                    self._drop_unit(unit)
+                            elif start is not None and unit.key == key and unit.container is container:
+                                if drop and key not in container: # the call created the record
+                                    self._drop_unit(unit)
+                                else:
+                                    self._exit_unit(unit)
+                        elif unit.key == key and unit.container is container: # the unit of this call
+                            if drop:
+                                self._drop_unit(unit)
+                            else:
+                                self._exit_unit(unit)
+                    if len(self.index) == 0:
+                        self.index.deeper('print') # return to regular print
+
+                if getattr(inspect, 'iscoroutinefunction', None) is not None and inspect.iscoroutinefunction(func):
+                    # the call lasts until the coroutine finishes, the tracing happens in the task that awaits it
+                    from ezprint_async import async_wrapper
+                    return async_wrapper(func, entry, exit, active=lambda: self.tracing)
+
+                @functools.wraps(func)
+                def wrapper(*wargs, **wkwargs):  # function wrapper that replaces the decorated function
+                    if not self.tracing: # switched off at runtime
+                        return func(*wargs, **wkwargs)
+                    plan = entry(wargs, wkwargs)
+                    try:
                         retval = func(*wargs, **wkwargs) #
-                    exit(*([retval] + list(args)), **kwargs)  # call wrappers with outer, decorator arguments
+                    except BaseException:
+                        exit(plan, None, returned=False) # keep the index consistent, there is no retval
+                        raise
+                    exit(plan, retval)
                     return retval
 
-                return wrapper if self.configfile.get_bool('use_function_wrappers') else func
+                return wrapper
 
             # class _C(object):
             #     def _m(self): pass
@@ -259,64 +1640,127 @@ class FastPrint(object):
             FunctionType = type(_f)
 
             if isinstance(args[0], type): # class wrapper
-                class NewCls(object):
-                    # CODE SOURCE: https://www.codementor.io/sheena/advanced-use-python-decorators-class-function-du107nxsv
-                    def __init__(self, *cargs, **ckwargs):
-                        self._oInstance = args[0](*cargs, **ckwargs)
-                        object.__getattribute__(self, '_oInstance').__setattr__('_NewCls_self', self)
-
-
-
-                    def __getattribute__(self, s):
-                        """
-                        this is called whenever any attribute of a NewCls object is accessed. This function first tries to
-                        get the attribute off NewCls. If it fails then it tries to fetch the attribute from self.oInstance (an
-                        instance of the decorated class). If it manages to fetch the attribute from self.oInstance, and
-                        the attribute is an instance method then `time_this` is applied.
-                        """
-                        # print '__getattribute__', str(self), s
-
-                        if s == '__getattribute__':
-                            return object.__getattribute__(self, '__getattribute__')
-
-                        try:
-                            x = super(NewCls, self).__getattribute__(s)
-                        except AttributeError:
-                            pass
-                        else:
-                            return x
-                        x = object.__getattribute__(self, '_oInstance').__getattribute__(s)
-                        if type(x) == type(object.__getattribute__(self, '__init__')):  # it is an instance method
-                            return decorate(x, self)  # this is equivalent of just decorating the method with decorate
-                        else:
-                            return x
-
-                return NewCls # return wrapped class
+                cls = args[0]
+                # the wrapped class is a subclass of the decorated class with the methods wrapped once, instances are
+                # regular instances of the decorated class (isinstance, __slots__, dunder methods work) and the self
+                # that the methods receive is the instance of the wrapped class, so calls of self methods are traced
+                namespace = {'__slots__': (), '__module__': cls.__module__, '__doc__': cls.__doc__, '__wrapped__': cls}
+                if hasattr(cls, '__qualname__'):
+                    namespace['__qualname__'] = cls.__qualname__
+                for klass in reversed(cls.__mro__[:-1]): # the most derived definition wins, object is skipped
+                    for name, attr in vars(klass).items():
+                        if name in self.UNTRACED_METHODS:
+                            continue
+                        if isinstance(attr, FunctionType):
+                            namespace[name] = decorate(attr, skip_first=True)
+                        elif isinstance(attr, staticmethod):
+                            namespace[name] = staticmethod(decorate(attr.__func__))
+                        elif isinstance(attr, classmethod):
+                            namespace[name] = classmethod(decorate(attr.__func__, skip_first=True))
+                        elif name in namespace:
+                            del namespace[name] # overridden by something that is not a method
+                methods = dict((name, attr) for name, attr in namespace.items() if isinstance(attr, (FunctionType,
+                               staticmethod, classmethod)))
+                if '__eq__' in namespace: # type() sets __hash__ to None for a class that defines __eq__ only
+                    namespace['__hash__'] = cls.__hash__
+                wrapped = type(cls)(cls.__name__, (cls,), namespace)
+                # the wrapped class is returned even when the tracing is off, the switch adds or removes the methods
+                self._switchable_classes[wrapped] = methods
+                if not self.__dict__.get('tracing', True): # the config is not needed (loaded) to decorate
+                    for name in methods:
+                        delattr(wrapped, name)
+                return wrapped # return wrapped class
 
             elif isinstance(args[0], FunctionType):
                 func = args[0]
-                return decorate(func)
+                wrapper = decorate(func)
+                if _binding(func)[1] is not None: # the switch can rebind the name of the function
+                    self._switchable[func] = wrapper
+                    if not self.__dict__.get('tracing', True): # the name gets the original, as if swapped by disable
+                        self._swapped.add(func)
+                return wrapper if self.__dict__.get('tracing', True) else func
+        elif self._mute.get() > 0: # print inside of a call that is not stored
+            self.dropped_records += len(kwargs) if len(args) == 0 else 1
         elif len(args) == 1 and len(kwargs) == 0: # single non-kw argument
-            self.add_record(self._next_counter() + '_' + type(args[0]).__name__, args[0])
+            self.add_print(type(args[0]).__name__, args[0])
         elif len(args) > 1 and isinstance(args[0], str): # if called with first param as string, all other
                                                          # params are treated as str format params
-            self.add_record(self._next_counter() + '_' + type(args[0]).__name__, args[0].format(*args[1:],**kwargs))
+            self.add_print(type(args[0]).__name__, args[0].format(*args[1:],**kwargs))
         elif len(args) == 0 and len(kwargs) >= 1: # single kw arguments
             for key, value in kwargs.items():
-                self.add_record(self._next_counter() + '_' + key, value)
+                self.add_print(key, value)
             # key, value = list(kwargs.items())[0]
             # self.add_record(key, value)
 
+    def add_print(self, name, value):
+        if self._events is not None:
+            self._events.record(self._intern(name), self._stringify(value))
+        elif self.flags.fold:
+            self._fold_value(name, value, folded=True)
+        else:
+            self.add_record(self._next_counter() + '_' + name, value)
+
+    def _folded(self, container, name):
+        # key of the folded record of name in the container, None if there is none
+        key = self._folds.get((id(container), name))
+        return key if key is not None and key in container else None
+
+    def _enter_fold(self, name, argsdict, record_calls):
+        # moves the index into the folded record of the call, it is created by the first call of the function
+        container = self.index.get_value()
+        key = self._folded(container, name + '()')
+        if key is None:
+            node = OrderedDict([('count', 0)])
+            key = self.add_dict(self._next_counter() + '_' + name, node)
+            self._folds[(id(container), name + '()')] = key
+            if self.flags.bounded and len(self.index) == 1: # top-level record, the unit is shared by all its calls
+                self._fold_units[key] = self._unit.get()
+        elif self._journal is not None: # updated in place, flushed again
+            self._journal.append((self.index.position(), key))
+        node = container[key]
+        node['count'] += 1
+        if argsdict: # functions without parameters have no sample
+            samples = node.setdefault('args', [])
+            if len(samples) < self.flags.fold_samples: # distinct arguments, formatted only until the sample is full
+                argsdict = OrderedDict((k, self._format_value(LazyValue(v))) for k, v in argsdict.items())
+                if argsdict not in samples:
+                    samples.append(argsdict)
+        self.index.deeper(key)
+        if record_calls:
+            if 'calls' not in node:
+                self.add_dict('calls', {})
+            self.index.deeper('calls')
+        return key
+
+    def _fold_value(self, name, value, folded=False):
+        # adds the value to the ValueStats of name in the head of the index, the prints are folded records themselves
+        container = self.index.get_value()
+        key = self._folded(container, name) if folded else (name if name in container else None)
+        if key is None:
+            stats = ValueStats(self.flags.fold_samples, lambda v: self._format_value(LazyValue(v)))
+            key = self.add_record(self._next_counter() + '_' + name if folded else name, stats, stringify=False)
+            if key is None:
+                return
+            if folded:
+                self._folds[(id(container), name)] = key
+        elif self._journal is not None:
+            self._journal.append((self.index.position(), key))
+        container[key].add(value)
+
     def jump_to_call(self):
-        if self.index.depth() > 0 and self.index.indices[0] != "calls":
-            self.index.indices = ['calls']
+        if self.index.depth() > 0 and self.index.first_index() != "calls":
+            self.index.reset('calls')
 
     def add_dict(self, key, d, index=None):
         if isinstance(d, dict):
-            d = OrderedDict(d)
+            if not isinstance(d, OrderedDict):
+                d = OrderedDict(d)
             return self.add_record(key, d, stringify=False)
 
     def add_record(self, key, value, index=None, stringify=True):
+        if self._mute.get() > 0: # inside of a call that is not stored
+            self.dropped_records += 1
+            return None
         if self.index.is_head_dict():
             return self.add_dict_record(key, value, index, stringify)
         elif self.index.is_head_list():
@@ -325,28 +1769,192 @@ class FastPrint(object):
     def add_dict_record(self, key, value, index=None, stringify=True):
         if index is None:
             index = self.index
-        index.get_value()[key] = self._stringify(value) if stringify else value
+        value = self._stringify(value) if stringify else value
+        index.get_value()[key] = value
+        if self._journal is not None:
+            self._journal.append((index.position(), key))
+        if self.flags.bounded:
+            self._account(index, key, value)
         return key
 
     def add_list_record(self, value, index=None, stringify=True):
         if index is None:
             index = self.index
-        index.get_value().append(self._stringify(value) if stringify else value)
-        return len(index.get_value()) - 1
+        value = self._stringify(value) if stringify else value
+        index.get_value().append(value)
+        key = len(index.get_value()) - 1
+        if self._journal is not None:
+            self._journal.append((index.position(), key))
+        if self.flags.bounded:
+            self._account(index, key, value)
+        return key
+
+    def _account(self, index, key, value):
+        # the size is approximate, referenced objects (LazyValue) are not included
+        nbytes = sys.getsizeof(key) + sys.getsizeof(value)
+        if isinstance(value, dict):
+            nbytes += sum(sys.getsizeof(v) for v in value.values())
+        unit = self._unit.get()
+        container = index.get_value()
+        with self._lock:
+            if unit is None or (len(index) == 1 and (unit.key != key or unit.container is not container)):
+                unit = _Unit(container, key) # top-level print (or call when folded)
+                if self.flags.fold: # folded records are evicted only whole
+                    unit.nested = None
+                self._units.append(unit)
+                self._unit.set(unit)
+            elif unit.key != key and isinstance(key, str) and key[:1].isdigit() and not self.flags.fold:
+                print_unit = _Unit(container, key, unit) # print in a call, evictable right away
+                print_unit.records = 1
+                print_unit.nbytes = nbytes
+                unit.root.nested.append(print_unit)
+            unit.records += 1
+            unit.nbytes += nbytes
+            self.nrecords += 1
+            self.nbytes += nbytes
+            flags = self.flags
+            if (flags.max_records > 0 and self.nrecords > flags.max_records) or \
+                    (flags.max_bytes > 0 and self.nbytes > flags.max_bytes):
+                self._evict()
+
+    def _hold(self, unit, n):
+        # number of the calls in progress in the unit, units with calls in progress are not evicted
+        with self._lock:
+            unit.calls = max(unit.calls + n, 0)
+
+    def _enter_unit(self, container, key, top):
+        # unit of a call that is being recorded, top-level units are evicted whole once they finish
+        with self._lock:
+            unit = _Unit(container, key, None if top else self._unit.get())
+            unit.calls = 1
+            if unit.parent is None:
+                self._units.append(unit)
+        self._unit.set(unit)
+        return unit
+
+    def _exit_unit(self, unit):
+        with self._lock:
+            unit.calls = 0
+            parent = unit.parent
+            if parent is None: # evicted whole from now on
+                unit.nested = None
+            else: # merged into the enclosing call, evictable on its own while the top-level call is in progress
+                parent.records += unit.records
+                parent.nbytes += unit.nbytes
+                if unit.root.nested is not None:
+                    unit.root.nested.append(unit)
+        self._unit.set(parent)
+
+    def _drop_unit(self, unit):
+        # the call was dropped with its subtree, its records are removed from the totals instead of being merged
+        with self._lock:
+            if unit.evicted: # a folded record evicted by another thread in the meantime
+                self._unit.set(unit.parent)
+                return
+            unit.evicted = True # its nested units are skipped by _evictable
+            unit.calls = 0
+            self.nrecords -= unit.records
+            self.nbytes -= unit.nbytes
+            if unit.parent is None:
+                if self._units and self._units[-1] is unit: # usually the last one
+                    self._units.pop()
+                else:
+                    self._units.remove(unit)
+                if self._fold_units.get(unit.key) is unit:
+                    del self._fold_units[unit.key]
+        self._unit.set(unit.parent)
+
+    def _evictable(self):
+        # the oldest finished top-level unit, the oldest finished nested unit otherwise, None if there is none
+        for i, unit in enumerate(self._units):
+            if unit.calls == 0:
+                del self._units[i]
+                return unit
+        for root in self._units:
+            nested = root.nested
+            while nested:
+                unit = nested.popleft()
+                if not unit.detached():
+                    return unit
+        return None
+
+    def _discount(self, unit):
+        # removes the records of the unit from the totals, of the enclosing units too where it was merged
+        self.nrecords -= unit.records
+        self.nbytes -= unit.nbytes
+        merged = unit
+        while merged.calls == 0 and merged.parent is not None:
+            merged = merged.parent
+            merged.records -= unit.records
+            merged.nbytes -= unit.nbytes
+
+    def _evict(self):
+        """
+        Evicts the oldest finished top-level calls and prints until the store fits into 90% of max_records and max_bytes,
+        so that the eviction (and the spill file) runs once per a batch of records, not for every new record. When
+        only top-level calls in progress are left, the oldest finished calls and prints nested in them are evicted, so
+        only the own records of the calls in progress (args, calls) are kept over the limits. Evicted records are
+        appended to spill_path if set.
+        """
+        flags = self.flags
+        max_records, max_bytes = int(flags.max_records * 0.9), int(flags.max_bytes * 0.9)
+        spill = printer = None
+        try:
+            while (flags.max_records > 0 and self.nrecords > max_records) or \
+                    (flags.max_bytes > 0 and self.nbytes > max_bytes):
+                unit = self._evictable()
+                if unit is None: # only the calls in progress are left
+                    break
+                value = unit.container.pop(unit.key, None)
+                unit.evicted = True
+                self._fold_units.pop(unit.key, None)
+                self._discount(unit)
+                self.evicted_records += unit.records
+                if flags.spill_path:
+                    if spill is None: # opened once per eviction, only when there is something to spill
+                        spill = open(flags.spill_path, 'a')
+                        printer = self._full_printer() # the spilled records are gone from memory
+                    spill.write(str(unit.key) + ': ')
+                    printer.write(value, spill)
+                    spill.write('\n')
+        finally:
+            if spill is not None:
+                spill.close()
 
     def _stringify(self, value, expand=False):
-        return str(value)
-        # if hasattr(value, '__dict__'): # is object
-        #     if type(value).__dict__['__str__'] is not object.__str__:
-        #         return str(value)
-
-        # str_op = getattr(self, "__str__", None)
-        # if callable(str_op):
-        #     if type(value).__dict__['__str__'] is not object.__str__:
-        #     invert_op(self.path.parent_op)
-        #
-        # if type(value).__dict__['__str__'] is not object.__str__:
-        # if isinstance(value, object):
+        capture = self.flags.capture
+        if capture == 'str':
+            if type(value) in _PLAIN_TYPES:
+                return str(value)
+            summary = self._value_formatter().summarize(value) # large values are not formatted whole
+            return str(value) if summary is None else summary
+        elif capture == 'ref':
+            return LazyValue(value)
+        else:
+            return LazyValue(self._snapshot(value))
+
+    def _snapshot(self, value):
+        # shallow copy of the mutable builtin containers, everything else is kept as a reference
+        if isinstance(value, (list, dict, set, bytearray, deque)):
+            return copy.copy(value)
+        return value
+
+    def _value_formatter(self):
+        formatter = self._formatter
+        flags = self.flags
+        if formatter is None or formatter.version != flags.version: # created again when the config changes
+            formatter = self._formatter = ValueFormatter(flags.max_value_chars, flags.max_value_items,
+                                                         flags.max_value_ms / 1000.0)
+            formatter.version = flags.version
+        return formatter
+
+    def _format_value(self, value):
+        if type(value) in _PLAIN_TYPES:
+            return str(value)
+        if isinstance(value, LazyValue):
+            return self._value_formatter()(value)
+        summary = self._value_formatter().summarize(value) # values of the args in capture str are kept as they are
+        return str(value) if summary is None else summary
 
 
 ff = FastPrint()
@@ -0,0 +1,26 @@
+# coroutine wrapper for ezprint, it is in its own module because the async syntax is not supported by python 2.x
+import functools
+
+
+def async_wrapper(func, entry, exit, call=None, active=None):
+    """
+    Wraps coroutine function func so that the traced call lasts until the coroutine finishes. entry and exit are the
+    callbacks of the ezprint function wrapper, call is the coroutine function that is actually called (func by default),
+    active returns false when the tracing is switched off and the call is only passed through.
+    """
+    call = func if call is None else call
+
+    @functools.wraps(func)
+    async def wrapper(*wargs, **wkwargs):
+        if active is not None and not active():
+            return await call(*wargs, **wkwargs)
+        plan = entry(wargs, wkwargs)
+        try:
+            retval = await call(*wargs, **wkwargs)
+        except BaseException:
+            exit(plan, None, returned=False) # keep the index consistent, there is no retval
+            raise
+        exit(plan, retval)
+        return retval
+
+    return wrapper
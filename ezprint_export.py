@@ -0,0 +1,142 @@
+# exporters of the ezprint call tree into the formats of standard profiling tools
+import json
+import os
+
+ENTER, EXIT, PRINT = 'enter', 'exit', 'print'
+
+
+def _record_name(key):
+    # name of the numbered record "012_NAME", None for the other keys (args, calls, retval, time, count)
+    if isinstance(key, str) and key[:1].isdigit():
+        i = key.find('_')
+        if i > 0 and key[:i].isdigit():
+            return key[i + 1:]
+    return None
+
+
+def _records(container):
+    # numbered records of the container, copied so that the json can grow meanwhile
+    return [(name, value) for name, value in ((_record_name(k), v) for k, v in list(container.items())) if name is not None]
+
+
+def iter_trace(tree):
+    """
+    Walks the call tree of the FastPrint json depth-first and generates (event, name, value) tuples, (ENTER, name, call
+    record) before the records of the call, (EXIT, name, call record) after them and (PRINT, name, value) for prints.
+    The tree is walked with an explicit stack, nothing is copied except the keys of the container being walked.
+    """
+    top = []
+    for section in ('print', 'calls'): # top-level prints go to calls after the first call
+        if isinstance(tree.get(section), dict):
+            top.extend(_records(tree[section]))
+    stack = [(iter(top), None, None)]
+    while len(stack) > 0:
+        items, name, record = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            if record is not None:
+                yield EXIT, name, record
+            continue
+        name, value = item
+        if isinstance(value, dict): # call, the nested records are in calls or in the call itself (simple)
+            yield ENTER, name, value
+            calls = value.get('calls')
+            stack.append((iter(_records(calls if isinstance(calls, dict) else value)), name, value))
+        else:
+            yield PRINT, name, value
+
+
+def write_collapsed(tree, out, timed=None):
+    """
+    Writes the call tree as collapsed stacks, one "outer;inner;leaf value" line per call, the format of flamegraph.pl,
+    speedscope and other flame graph tools. Values are self times in nanoseconds when the calls were profiled and
+    numbers of calls otherwise (timed is decided by the first call when None).
+    """
+    path = []
+    children = [] # time (or count) of the children of the calls in path
+    for event, name, value in iter_trace(tree):
+        if event == ENTER:
+            if timed is None:
+                timed = value.get('time') is not None
+            path.append(name.replace(';', ':').replace(' ', '_'))
+            children.append(0)
+        elif event == EXIT:
+            stack = ';'.join(path)
+            path.pop()
+            nested = children.pop()
+            if timed:
+                calltime = value.get('time')
+                total = calltime.wall if calltime is not None else nested
+                own = max(total - nested, 0)
+            else:
+                total = own = value.get('count', 1) if isinstance(value.get('count', 1), int) else 1
+            if len(children) > 0:
+                children[-1] += total
+            if own > 0:
+                out.write('{} {}\n'.format(stack, own))
+
+
+def write_chrome_trace(tree, out, formatter=str, pid=None, tid=0):
+    """
+    Writes the call tree as Chrome trace-event json (chrome://tracing, Perfetto, speedscope), the calls are begin and
+    end events, the prints are instant events. Profiled calls have their real times, the other calls are laid out on
+    a logical clock of 1 us ticks. Top-level calls that overlap in time (threads, asyncio tasks) are laid out on
+    separate lanes, tid, tid + 1, ..., a lane is reused once its call has ended. Events are written one by one, the
+    output is not held in memory.
+    """
+    pid = os.getpid() if pid is None else pid
+    out.write('{"displayTimeUnit": "ns", "traceEvents": [\n')
+    out.write(json.dumps({'name': 'process_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': 'ezprint'}}))
+    clock = [0, None] # last timestamp in ns, offset of the profiled times
+    lanes = [] # end timestamp of the last top-level call of every lane
+    depth = 0
+    lane = tid
+
+    def timestamp(ns=None):
+        if ns is None: # next tick of the logical clock
+            clock[0] += 1000
+        else:
+            if clock[1] is None:
+                clock[1] = ns - clock[0] - 1000
+            clock[0] = max(clock[0], ns - clock[1])
+            return (ns - clock[1]) / 1000.0
+        return clock[0] / 1000.0
+
+    for event, name, value in iter_trace(tree):
+        if event == ENTER:
+            calltime = value.get('time')
+            ts = timestamp(calltime.start if calltime is not None else None)
+            if depth == 0: # the first lane that is free at the start of the call
+                free = next((i for i, end in enumerate(lanes) if end <= ts), None)
+                if free is None:
+                    free = len(lanes)
+                    lanes.append(ts)
+                    out.write(',\n')
+                    out.write(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid + free,
+                                          'args': {'name': 'calls {}'.format(free)}}))
+                lane = tid + free
+            depth += 1
+            e = {'name': name, 'cat': 'ff', 'ph': 'B', 'pid': pid, 'tid': lane, 'ts': ts}
+            args = value.get('args')
+            if isinstance(args, dict):
+                e['args'] = dict((str(k), formatter(v)) for k, v in args.items())
+            elif isinstance(args, list): # sample of the folded call
+                e['args'] = {'samples': [dict((str(k), formatter(v)) for k, v in a.items()) for a in args]}
+            if 'count' in value:
+                e.setdefault('args', {})['count'] = value['count']
+        elif event == EXIT:
+            calltime = value.get('time')
+            e = {'name': name, 'cat': 'ff', 'ph': 'E', 'pid': pid, 'tid': lane,
+                 'ts': timestamp(calltime.start + calltime.wall if calltime is not None else None)}
+            depth -= 1
+            if depth == 0:
+                lanes[lane - tid] = e['ts']
+            if 'retval' in value:
+                e['args'] = {'retval': formatter(value['retval'])}
+        else:
+            e = {'name': name, 'cat': 'ff', 'ph': 'i', 's': 't', 'pid': pid, 'tid': lane, 'ts': timestamp(),
+                 'args': {'value': formatter(value)}}
+        out.write(',\n')
+        out.write(json.dumps(e))
+    out.write('\n]}\n')
@@ -0,0 +1,197 @@
+"""
+Trace shards of the processes traced by ezprint and their merging into one call tree.
+
+Every process with the config field shard_dir set (or the environment variable EZPRINT_SHARD_DIR, which is inherited by
+the worker processes) writes its trace into the directory when it exits. The shards are merged by
+
+    python ezprint_shard.py DIR                         # print the merged tree
+    python ezprint_shard.py DIR --format chrome -o trace.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import sys
+import time
+import zlib
+from collections import OrderedDict
+
+from ezprint import CallTime, JsonPrinter
+
+SHARD_VERSION = 2
+SHARD_SUFFIX = '.ffshard'
+SHARD_MAGIC = b'EZPRINT-SHARD\n'
+_CALLTIME = '\x00calltime' # key of the json object of a CallTime, never a key of the FastPrint json
+
+
+def plain_tree(tree, formatter=str):
+    """
+    Copy of the FastPrint json with the leaf values formatted by formatter, numbers and CallTime are kept, so the copy
+    doesn't reference any traced object and can be written as json.
+    """
+    def plain(value):
+        if isinstance(value, dict):
+            copy = OrderedDict()
+        elif isinstance(value, list):
+            copy = []
+        elif isinstance(value, (int, float, CallTime)) and not isinstance(value, bool):
+            return value
+        else:
+            return formatter(value)
+        stack.append((value, copy))
+        return copy
+
+    stack = []
+    root = plain(tree)
+    while len(stack) > 0:
+        src, dst = stack.pop()
+        if isinstance(src, dict):
+            for key, value in list(src.items()):
+                dst[key] = plain(value)
+        else:
+            for value in list(src):
+                dst.append(plain(value))
+    return root
+
+
+def write_shard(tree, directory, parent=None, formatter=str, started=None):
+    """
+    Writes the trace of the current process into directory and returns the path of the shard. parent is (pid, index
+    path) of the call in the parent process that started this one, the path is None if it is unknown. The shard is
+    written into a temporary file first, so a reader never sees a partial shard. It holds data only, a json header line
+    and the zlib-compressed json tree.
+    """
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError: # created by another process meanwhile
+            if not os.path.isdir(directory):
+                raise
+    pid = os.getpid()
+    header = {'version': SHARD_VERSION, 'pid': pid, 'host': platform.node(), 'argv': list(sys.argv),
+              'ppid': parent[0] if parent is not None else None,
+              'context': list(parent[1]) if parent is not None and parent[1] is not None else None,
+              'started': time.time() if started is None else started, 'written': time.time()}
+    body = json.dumps(plain_tree(tree, formatter), default=_encode)
+    path = os.path.join(directory, 'ezprint-{}-{}{}'.format(platform.node(), pid, SHARD_SUFFIX))
+    tmp = '{}.{}.tmp'.format(path, pid)
+    with open(tmp, 'wb') as f:
+        f.write(SHARD_MAGIC + json.dumps(header).encode('utf-8') + b'\n')
+        f.write(zlib.compress(body.encode('utf-8')))
+    getattr(os, 'replace', os.rename)(tmp, path)
+    return path
+
+
+def _encode(value):
+    if isinstance(value, CallTime):
+        return {_CALLTIME: [value.start, value.wall, value.cpu]}
+    raise TypeError('{} can not be written into a shard'.format(type(value).__name__))
+
+
+def _decode(pairs):
+    if len(pairs) == 1 and pairs[0][0] == _CALLTIME:
+        start, wall, cpu = pairs[0][1]
+        return CallTime(start, wall, cpu)
+    return OrderedDict(pairs)
+
+
+def read_shard(path):
+    """
+    Reads the shard written by write_shard, the header is checked before the tree is decompressed. Shards are json, so
+    reading the shards of a shared directory can't run any code.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(SHARD_MAGIC)) != SHARD_MAGIC:
+            raise ValueError('{} is not an ezprint shard'.format(path))
+        try:
+            shard = json.loads(f.readline().decode('utf-8'))
+        except ValueError:
+            raise ValueError('{} has a broken header'.format(path))
+        if not isinstance(shard, dict) or shard.get('version') != SHARD_VERSION:
+            raise ValueError('{} is a shard of version {}, expected {}'.format(
+                path, shard.get('version') if isinstance(shard, dict) else None, SHARD_VERSION))
+        shard['tree'] = json.loads(zlib.decompress(f.read()).decode('utf-8'), object_pairs_hook=_decode)
+    if not isinstance(shard['tree'], dict):
+        raise ValueError('{} has no call tree'.format(path))
+    return shard
+
+
+def _follow(container, path):
+    # container at the index path, None if the path is not in the tree
+    for key in path:
+        if not isinstance(container, dict) or key not in container:
+            return None
+        container = container[key]
+    return container if isinstance(container, dict) else None
+
+
+def merge_shards(directory):
+    """
+    Merges the shards in directory into one FastPrint json. Records of every process become a call record
+    "NNN_process_PID" that is placed into the call of its parent process it was started from (or among the top-level
+    calls of the parent when the call is not known), the processes are ordered by their start time.
+    """
+    shards = [read_shard(path) for path in sorted(glob.glob(os.path.join(directory, '*' + SHARD_SUFFIX)))]
+    shards.sort(key=lambda shard: shard['started'])
+    by_pid = dict(((shard['host'], shard['pid']), shard) for shard in shards)
+
+    # top-level records of every shard, the records of forked processes are at the end of their context path
+    for shard in shards:
+        tree = shard['tree']
+        top = OrderedDict(tree.get('print', {}))
+        top.update(tree.get('calls', {}))
+        shard['records'] = top
+        if shard['context']:
+            records = _follow(tree, shard['context'])
+            if records is not None:
+                shard['records'] = records
+        shard['top'] = top
+
+    merged = OrderedDict([('print', OrderedDict()), ('calls', OrderedDict())])
+    roots = [shard for shard in shards if (shard['host'], shard['ppid']) not in by_pid]
+    if len(roots) == 1: # the main process, its records stay at the top
+        root = roots[0]
+        merged['calls'] = root['top']
+    for n, shard in enumerate(shards):
+        if len(roots) == 1 and shard is roots[0]:
+            continue
+        parent = by_pid.get((shard['host'], shard['ppid']))
+        if parent is None:
+            container = merged['calls']
+        else:
+            container = _follow(parent['top'], shard['context'][1:]) if shard['context'] else None
+            container = parent['records' if shard['context'] is None else 'top'] if container is None else container
+        args = OrderedDict([('pid', shard['pid']), ('ppid', shard['ppid']), ('argv', ' '.join(shard['argv']))])
+        container['{}_process_{}'.format(str(n).zfill(3), shard['pid'])] = OrderedDict([('args', args),
+                                                                                       ('calls', shard['records'])])
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge the ezprint trace shards of processes into one call tree')
+    parser.add_argument('directory', help='directory with the shards (shard_dir)')
+    parser.add_argument('-o', '--out', help='output file, stdout by default')
+    parser.add_argument('--format', choices=('text', 'collapsed', 'chrome'), default='text',
+                        help='text tree as printed by ff(), collapsed stacks or chrome trace events (default: %(default)s)')
+    args = parser.parse_args(argv)
+
+    merged = merge_shards(args.directory)
+    out = sys.stdout if args.out is None else open(args.out, 'w')
+    try:
+        if args.format == 'text':
+            JsonPrinter(ncols=None, nlistcollapse=None, ndictcollapse=None).jprint(merged, out)
+        elif args.format == 'collapsed':
+            from ezprint_export import write_collapsed
+            write_collapsed(merged, out)
+        else:
+            from ezprint_export import write_chrome_trace
+            write_chrome_trace(merged, out)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,95 @@
+import os
+
+import pytest
+
+from ezconfig import ConfigField, ConfigFile, LayeredConfig
+
+
+def write_config(path, a):
+    path.write_text('a;int;{}\nb;string;x#comment\n'.format(a))
+
+
+def test_cache_is_used_while_the_config_is_unchanged(tmp_path, monkeypatch):
+    path = tmp_path / 'config.txt'
+    write_config(path, 1)
+    ConfigFile(str(path), cache=True)
+    assert os.path.exists(ConfigFile.cache_path(str(path)))
+    with monkeypatch.context() as m:
+        m.setattr(ConfigField, 'parse', lambda self, s: pytest.fail('parsed instead of loaded from the cache'))
+        config = ConfigFile(str(path), cache=True)
+    assert (config.get_int('a'), config.get_string('b'), config.fields['b'].comment) == (1, 'x', 'comment')
+
+
+def test_cache_is_invalidated_by_an_edit_within_the_mtime(tmp_path):
+    path = tmp_path / 'config.txt'
+    write_config(path, 1)
+    ConfigFile(str(path), cache=True)
+    stat = os.stat(str(path))
+    write_config(path, 2) # same size
+    os.utime(str(path), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert ConfigFile(str(path), cache=True).get_int('a') == 2
+
+
+def test_broken_or_invalid_cache_is_parsed_again(tmp_path):
+    path = tmp_path / 'config.txt'
+    write_config(path, 1)
+    cache = ConfigFile.cache_path(str(path))
+    with open(cache, 'wb') as f:
+        f.write(b'garbage')
+    assert ConfigFile(str(path), cache=True).get_int('a') == 1
+    # a sidecar with the right key but a value of the wrong type is not trusted
+    ConfigFile._write_cache(str(path), ConfigFile._cache_key(str(path)), [('a', 'int', 'os.system', None, '')])
+    assert ConfigFile(str(path), cache=True).get_int('a') == 1
+
+
+def layers():
+    base = ConfigFile()
+    base.add_int('a', 1)
+    base.add_int('b', 2)
+    env = ConfigFile()
+    env.add_int('b', 20)
+    return base, env
+
+
+def test_layered_config_follows_changes_of_the_layers(tmp_path):
+    base, env = layers()
+    config = LayeredConfig([base, env])
+    assert (config.get_int('a'), config.get_int('b')) == (1, 20)
+    assert config.source('b') is env
+
+    base.set_value('a', 10)
+    base.set_value('b', 200) # still overridden by env
+    assert (config.get_int('a'), config.get_int('b')) == (10, 20)
+
+    del env.fields['b']
+    env.changed(['b'])
+    assert config.get_int('b') == 200 and config.source('b') is base
+
+    path = tmp_path / 'env.txt'
+    path.write_text('c;int;3\n')
+    env.load(str(path))
+    assert config.get_int('c') == 3 and config.source('c') is env
+
+    env.fields.clear()
+    env.changed() # all the fields the layer supplied are looked up again
+    assert not config.contains('c') and config.source('b') is base
+
+
+def test_layered_config_changes_go_to_the_top_layer():
+    base, env = layers()
+    config = LayeredConfig([base, env])
+    child = config.new_child()
+    child.set_value('a', 5)
+    assert (child.get_int('a'), config.get_int('a'), base.get_int('a')) == (5, 1, 1)
+    assert child.source('a') is child.layers[-1]
+
+
+def test_layered_config_as_a_layer():
+    base, env = layers()
+    inner = LayeredConfig([base, env])
+    top = ConfigFile()
+    top.add_int('a', 100)
+    outer = LayeredConfig([inner, top])
+    assert (outer.get_int('a'), outer.get_int('b')) == (100, 20)
+    env.set_value('b', 21) # propagated through the inner LayeredConfig
+    assert outer.get_int('b') == 21
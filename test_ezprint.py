@@ -0,0 +1,155 @@
+import pytest
+
+import ezprint
+from ezprint import FastPrint
+
+
+@pytest.fixture
+def ff(tmp_path, capsys):
+    ff = FastPrint(str(tmp_path / 'fastprint_config.txt'))
+    ff.configfile # the config is created on the first use
+    capsys.readouterr()
+    return ff
+
+
+def test_cap_holds_for_long_running_top_level_call(ff, tmp_path):
+    spill = tmp_path / 'spill.txt'
+    ff.config(max_records=100, spill_path=str(spill))
+
+    @ff
+    def child(i):
+        ff(i=i)
+        return i
+
+    @ff
+    def root(n):
+        for i in range(n):
+            child(i)
+            assert ff.nrecords <= 100
+        return n
+
+    root(300)
+    calls = ff.json['calls']['000_ROOT']['calls']
+    assert '001_CHILD' not in calls
+    assert list(calls.values())[-1]['args'] == {'i': 299} # the latest calls are kept
+    assert ff.evicted_records > 0
+    assert '001_CHILD: ' in spill.read_text()
+
+
+def test_calls_in_progress_are_not_evicted(ff, tmp_path):
+    spill = tmp_path / 'spill.txt'
+    ff.config(max_records=3, spill_path=str(spill))
+
+    @ff
+    def recurse(n):
+        if n > 0:
+            return recurse(n - 1)
+        assert ff.nrecords > 3 and ff.evicted_records == 0
+        assert not spill.exists() # nothing to evict, the spill file is not opened
+        return n
+
+    recurse(5)
+    assert ff.evicted_records > 0 # the finished calls are evicted
+
+
+@pytest.mark.parametrize('fold', [False, True])
+def test_dropped_calls_are_not_counted(ff, tmp_path, monkeypatch, fold):
+    now = [0.0]
+    monkeypatch.setattr(ezprint, '_clock', lambda: now[0])
+    reference = FastPrint(str(tmp_path / 'reference_config.txt')) # traces only the calls that are kept
+    for tracer in (ff, reference):
+        tracer.config(max_records=1000, fold=fold)
+    ff.config(sample_slower_than=0.5)
+
+    def run(tracer, slow_only):
+        @tracer
+        def inner(i):
+            tracer(i=i)
+            return i
+
+        @tracer
+        def outer(i, slow):
+            inner(i)
+            inner(i + 1)
+            if slow:
+                now[0] += 1.0
+            return i
+
+        for i in range(20):
+            if i % 5 == 4 or not slow_only: # the first call is dropped
+                outer(i, i % 5 == 4)
+
+    run(ff, False)
+    run(reference, True)
+    assert ff.unsampled_calls == 16
+    assert (ff.nrecords, ff.nbytes) == (reference.nrecords, reference.nbytes)
+    assert len(ff._units) == len(ff.json['calls'])
+
+
+def test_global_sampling_decides_at_the_top_level(ff):
+    ff.config(sample_every=2)
+
+    @ff
+    def g(i):
+        return i
+
+    @ff
+    def f(i):
+        g(i)
+        g(i)
+        return i
+
+    for i in range(4):
+        f(i)
+        g(i)
+    calls = ff.json['calls']
+    assert list(calls) == ['000_F', '003_F', '006_F', '009_F'] # every other top-level call, with all its calls
+    assert all(len(call['calls']) == 2 for call in calls.values())
+    assert ff.unsampled_calls == 4
+
+
+def test_global_sampling_counts_are_shared(ff):
+    ff.config(sample_first=3)
+
+    @ff
+    def f():
+        pass
+
+    @ff
+    def g():
+        pass
+
+    for _ in range(3):
+        f()
+        g()
+    assert list(ff.json['calls']) == ['000_F', '001_G', '002_F']
+
+
+def test_sampled_policy_applies_to_nested_calls(ff):
+    @ff.sampled(every=2)
+    def inner(i):
+        return i
+
+    @ff
+    def outer():
+        for i in range(4):
+            inner(i)
+
+    outer()
+    assert [call['args'] for call in ff.json['calls']['000_OUTER']['calls'].values()] == [{'i': 0}, {'i': 2}]
+
+
+def test_fold_without_samples(ff):
+    ff.config(fold=True, fold_samples=0)
+
+    @ff
+    def f(i):
+        return str(i)
+
+    f(1)
+    f(2)
+    f(1)
+    assert str(ff.json['calls']['000_F']['retval']) == '3 values, ...'
+    stats = ezprint.ValueStats(nsamples=0)
+    stats.add('a')
+    assert str(stats) == '1 values, ...'
@@ -0,0 +1,57 @@
+import json
+import os
+from collections import OrderedDict
+
+import pytest
+
+import ezprint_shard
+from ezprint import CallTime
+from ezprint_shard import SHARD_MAGIC, merge_shards, read_shard, write_shard
+
+
+def test_shard_round_trip(tmp_path):
+    tree = OrderedDict([('print', OrderedDict([('000_x', 1.5)])),
+                        ('calls', OrderedDict([('001_F', OrderedDict([('args', OrderedDict([('a', object())])),
+                                                                      ('retval', '[2]'),
+                                                                      ('time', CallTime(10, 20, 5))]))]))])
+    path = write_shard(tree, str(tmp_path), parent=(1, ['calls', '001_F', 'calls']), started=3.0)
+    shard = read_shard(path)
+    assert (shard['pid'], shard['ppid'], shard['context'], shard['started']) == (os.getpid(), 1,
+                                                                               ['calls', '001_F', 'calls'], 3.0)
+    call = shard['tree']['calls']['001_F']
+    assert shard['tree']['print'] == {'000_x': 1.5}
+    assert call['args']['a'].startswith('<object object')
+    assert call['retval'] == '[2]'
+    assert (call['time'].start, call['time'].wall, call['time'].cpu) == (10, 20, 5)
+
+
+def test_read_shard_rejects_other_files(tmp_path):
+    other = tmp_path / 'other.ffshard'
+    other.write_bytes(b'\x80\x04pickled')
+    with pytest.raises(ValueError, match='not an ezprint shard'):
+        read_shard(str(other))
+    old = tmp_path / 'old.ffshard'
+    old.write_bytes(SHARD_MAGIC + json.dumps({'version': 1}).encode('utf-8') + b'\n')
+    with pytest.raises(ValueError, match='version 1'):
+        read_shard(str(old))
+
+
+def test_merge_nests_workers_in_their_parent_call(tmp_path, monkeypatch):
+    def write(pid, tree, parent, started):
+        monkeypatch.setattr(ezprint_shard.os, 'getpid', lambda: pid)
+        write_shard(tree, str(tmp_path), parent=parent, started=started)
+
+    main = OrderedDict([('000_MAIN', OrderedDict([('calls', OrderedDict([('001_x', 1)]))]))])
+    write(100, OrderedDict([('print', OrderedDict()), ('calls', main)]), None, 1.0)
+    # a forked worker has the records of the parent up to the call it was started from
+    forked = OrderedDict([('000_MAIN', OrderedDict([('calls', OrderedDict([('002_WORK', 'done')]))]))])
+    write(200, OrderedDict([('print', OrderedDict()), ('calls', forked)]), (100, ['calls', '000_MAIN', 'calls']), 2.0)
+    spawned = OrderedDict([('000_TASK', 'done')])
+    write(300, OrderedDict([('print', OrderedDict()), ('calls', spawned)]), (100, None), 3.0)
+
+    merged = merge_shards(str(tmp_path))
+    calls = merged['calls']['000_MAIN']['calls']
+    assert list(calls) == ['001_x', '001_process_200']
+    assert calls['001_process_200']['args']['ppid'] == 100
+    assert calls['001_process_200']['calls'] == {'002_WORK': 'done'}
+    assert merged['calls']['002_process_300']['calls'] == {'000_TASK': 'done'}